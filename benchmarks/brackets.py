@@ -0,0 +1,40 @@
+import lexer.symbols as s
+import lexer.utils as u
+from benchmarks.utils import ANARCHISM, read, best_of
+
+""" Brackets pairing and Markup offsets in pure python against numpy, the crossover is the size from which numpy is
+faster and it's the default vectorize threshold """
+
+SIZES = (1000, 2000, 4000, 8000, 16000, 32000, 64000, 256000, 1024000, 4096000)
+
+
+def crossover(name, index, build, source):
+    default = index.vectorize
+    found = None
+    print(f'{name}\n{"chars":>10} {"python ms":>10} {"numpy ms":>10}')
+    for size in SIZES:
+        text = (source * (size // len(source) + 1))[:size]
+        index.vectorize = float('inf')
+        python = best_of(lambda: build(text), number=3)
+        index.vectorize = 0
+        vectorized = best_of(lambda: build(text), number=3)
+        if found is None and vectorized < python:
+            found = size
+        print(f'{size:>10} {python * 1000:>10.3f} {vectorized * 1000:>10.3f}')
+
+    index.vectorize = default
+    print(f'numpy is faster from {found} chars\n')
+
+
+def main():
+    if u.np is None:
+        print('numpy is not installed')
+        return
+
+    source = read(ANARCHISM)
+    crossover('Brackets', u.Brackets, lambda text: u.Brackets(text, s.BRACKETS), source)
+    crossover('Markup', u.Markup, lambda text: u.Markup(text, s.WIKIMEDIA_MARKUP), source)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+from compiler import Compiler
+from lexer.utils import clean
+from benchmarks.utils import ANARCHISM, read, best_of, report
+
+""" clean on a rendered article and on table heavy pages, the time per char stays flat as tables grow """
+
+TABLE = "{| class=\"wikitable\"\n|-\n! Team !! '''Points'''\n|-\n| ''Home'' || 3<ref name=\"r\"/>\n|}\n" \
+        "Result of round '''%d'''.<ref>Source</ref>\n"
+
+
+def main():
+    text = Compiler().render(Compiler().parser.parse(read(ANARCHISM)))
+    report('anarchism', best_of(lambda: clean(text)), len(text))
+    for tables in (100, 1000, 10000):
+        text = ''.join(TABLE % i for i in range(tables))
+        report(f'{tables} tables', best_of(lambda: clean(text), 3), len(text))
+
+
+if __name__ == '__main__':
+    main()
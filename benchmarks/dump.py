@@ -0,0 +1,48 @@
+import os
+import tempfile
+import time
+from pathlib import Path
+from compiler import Compiler
+from config import TEST_DATA
+from dump import DumpIndex, MultistreamDump, write_multistream
+from benchmarks.utils import ANARCHISM, best_of, read
+
+""" Multistream dump compile throughput by number of workers, against reading and compiling in this process, and
+lookup of one page through a DumpIndex against a scan of the dump """
+
+
+def main(copies=40):
+    articles = [read(ANARCHISM), read(TEST_DATA / 'wikitext_algeria'), read(TEST_DATA / 'wikitext_link_extraction')]
+    pages = [(id, f'Article {id}', text) for id, text in enumerate(articles * copies, 1)]
+    with tempfile.TemporaryDirectory() as directory:
+        path, index = Path(directory) / 'dump.xml.bz2', Path(directory) / 'index.txt.bz2'
+        write_multistream(pages, path, index, per_stream=10)
+        dump = MultistreamDump(path, index)
+        compiler = Compiler()
+
+        start = time.perf_counter()
+        for _, _, text in dump.pages():
+            compiler.compile(text)
+        single = time.perf_counter() - start
+        print(f'{"pages + compile":<32} {len(pages) / single:8.1f} articles/s')
+
+        workers = 1
+        while workers <= os.cpu_count():
+            start = time.perf_counter()
+            for _ in dump.compile(workers=workers):
+                pass
+            seconds = time.perf_counter() - start
+            print(f'{f"compile workers={workers}":<32} {len(pages) / seconds:8.1f} articles/s {single / seconds:6.2f}x')
+            workers *= 2
+
+        lookup = DumpIndex.build(Path(directory) / 'index.db', path, index)
+        middle = pages[len(pages) // 2]
+        scan = best_of(lambda: next(page for page in dump.pages() if page[0] == middle[0]), number=1)
+        seek = best_of(lambda: lookup.get(middle[1]), number=20)
+        print(f'{"scan for one page":<32} {scan * 1000:10.2f} ms')
+        print(f'{"DumpIndex.get":<32} {seek * 1000:10.2f} ms {scan / seek:6.1f}x')
+        lookup.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+import parser.parser as p
+from benchmarks.utils import ANARCHISM, read, best_of, report
+
+""" Parsing time with and without packrat memoization, on an article and on deeply nested links and headings """
+
+
+def nested(depth=40, headings=200):
+    links = ''.join('[[x|' * d + 'y' + ']]' * d + '\n' for d in range(1, depth))
+    return links + ('== [[a|[[b|[[c]]]]]] {{t}} ==\n' + '== [[a|[[b]]]] broken\n') * headings
+
+
+def main():
+    articles = {
+        'anarchism': read(ANARCHISM),
+        'nested links and headings': nested(),
+    }
+
+    for name, text in articles.items():
+        print(f'{name} ({len(text)} chars)')
+        for packrat in (False, True):
+            parser = p.Parser(packrat=packrat)
+            report(f'packrat={packrat}', best_of(lambda: parser.parse(text)), len(text))
+
+
+if __name__ == '__main__':
+    main()
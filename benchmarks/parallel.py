@@ -0,0 +1,34 @@
+import os
+import time
+from compiler import Compiler
+from config import TEST_DATA
+from benchmarks.utils import ANARCHISM, read
+
+""" compile_many throughput by number of workers, against compiling in this process """
+
+
+def main(copies=40):
+    articles = [read(ANARCHISM), read(TEST_DATA / 'wikitext_algeria'), read(TEST_DATA / 'wikitext_link_extraction')]
+    texts = articles * copies
+    size = sum(len(text) for text in texts)
+    compiler = Compiler()
+
+    start = time.perf_counter()
+    for text in texts:
+        compiler.compile(text)
+    single = time.perf_counter() - start
+    print(f'{"compile":<32} {len(texts) / single:8.1f} articles/s {size / single / 1e6:8.2f} Mchar/s')
+
+    workers = 1
+    while workers <= os.cpu_count():
+        start = time.perf_counter()
+        for _ in compiler.compile_many(texts, workers=workers, chunksize=4):
+            pass
+        seconds = time.perf_counter() - start
+        print(f'{f"compile_many workers={workers}":<32} {len(texts) / seconds:8.1f} articles/s '
+              f'{size / seconds / 1e6:8.2f} Mchar/s {single / seconds:6.2f}x')
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
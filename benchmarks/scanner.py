@@ -0,0 +1,20 @@
+import lexer.lexer as l
+from benchmarks.utils import ANARCHISM, read, best_of, report
+
+""" Throughput of the master regex scanner against the symbol by symbol lexer """
+
+
+def main():
+    text = read(ANARCHISM)
+    sequential = l.Lexer(scanner=False)
+    scanner = l.Lexer()
+    assert [(t.token.tag, t.text) for t in sequential.tokenize(text)] == \
+           [(t.token.tag, t.text) for t in scanner.tokenize(text)]
+
+    print(f'{ANARCHISM.name} ({len(text)} chars)')
+    report('sequential', best_of(lambda: sequential.tokenize(text)), len(text))
+    report('scanner', best_of(lambda: scanner.tokenize(text)), len(text))
+
+
+if __name__ == '__main__':
+    main()
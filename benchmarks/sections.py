@@ -0,0 +1,16 @@
+from compiler import Compiler
+from benchmarks.utils import ANARCHISM, read, best_of, report
+
+""" Lead section against the whole article, the split alone is the cost paid for the sections never accessed """
+
+
+def main():
+    text = read(ANARCHISM)
+    compiler = Compiler()
+    report('compile', best_of(lambda: compiler.compile(text)), len(text))
+    report('split', best_of(lambda: compiler.sections(text)), len(text))
+    report('lead', best_of(lambda: compiler.sections(text).lead.text), len(text))
+
+
+if __name__ == '__main__':
+    main()
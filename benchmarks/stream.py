@@ -0,0 +1,29 @@
+import tracemalloc
+from compiler import Compiler
+from benchmarks.utils import ANARCHISM, read, best_of, report
+
+""" Compile against streaming compile and compile_to, time and peak memory of the whole run """
+
+
+def peak(fn):
+    tracemalloc.start()
+    fn()
+    _, size = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+
+def main():
+    source = read(ANARCHISM)
+    for copies in (1, 8):
+        text = source * copies
+        compiler = Compiler()
+        print(f'anarchism x{copies} ({len(text)} chars)')
+        for name, fn in (('compile', compiler.compile), ('stream', compiler.stream),
+                         ('compile_to', lambda t: compiler.compile_to(t, lambda chunk: None))):
+            report(name, best_of(lambda: fn(text), 3, 3), len(text))
+            print(f'{"":<32} {peak(lambda: fn(text)) / 1e6:10.2f} MB peak')
+
+
+if __name__ == '__main__':
+    main()
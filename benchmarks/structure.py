@@ -0,0 +1,23 @@
+from compiler import Compiler, ParseTypes
+from benchmarks.utils import ANARCHISM, read, best_of, report
+
+""" Structured record of an article in one walk against compile followed by a listener pass for links and one for
+templates """
+
+
+def main():
+    text = read(ANARCHISM)
+    compiler = Compiler()
+
+    def passes():
+        compiler.compile(text)
+        compiler.extract(text, [ParseTypes.LINK])
+        compiler.extract(text, [ParseTypes.TEMPLATE])
+
+    report('compile', best_of(lambda: compiler.compile(text)), len(text))
+    report('compile + 2 extract passes', best_of(passes), len(text))
+    report('structure', best_of(lambda: compiler.structure(text)), len(text))
+
+
+if __name__ == '__main__':
+    main()
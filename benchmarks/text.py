@@ -0,0 +1,31 @@
+import lexer.lexer as l
+import lexer.symbols as s
+import lexer.utils as u
+from compiler import Compiler
+from benchmarks.utils import ANARCHISM, read, best_of, report
+
+""" Lexing time of text heavy articles against a single regex scan of their markup, and the Text lookahead regex
+lexing used to run at every text token """
+
+
+def main():
+    source = read(ANARCHISM)
+    plain = ' '.join(Compiler().compile(source).split())
+    articles = {
+        'anarchism': source,
+        'text heavy': (plain + '\n') * 4,
+        'unclosed <code> tags': 'Some text with a stray <code marker and [[a link]] here.\n' * 4000,
+    }
+    scan = u.lookahead([token for tag in s.WIKIMEDIA_MARKUP for token in (tag.start, tag.end)])
+
+    for name, text in articles.items():
+        lexer = l.Lexer()
+        print(f'{name} ({len(text)} chars)')
+        report('one regex scan', best_of(lambda: sum(1 for _ in scan.finditer(text))), len(text))
+        report('Text lookahead regex', best_of(lambda: sum(1 for _ in s.Text.start.re.finditer(text)), 1, 1),
+               len(text))
+        report('lexer', best_of(lambda: sum(1 for _ in lexer.iter_tokens(text))), len(text))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+import timeit
+from config import ROOT
+
+""" Helpers shared by the benchmark scripts, run them from the root folder e.g. python -m benchmarks.scanner """
+
+ANARCHISM = ROOT / 'examples' / 'data' / 'wikitext_anarchism.txt'
+
+
+def read(path):
+    with path.open(encoding='utf8') as f:
+        return f.read()
+
+
+def best_of(fn, number=5, repeat=3):
+    """ Best wall time of a single call to fn, in seconds """
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def report(name, seconds, size):
+    print(f'{name:<32} {seconds * 1000:10.2f} ms {size / seconds / 1e6:8.2f} Mchar/s')
@@ -0,0 +1,120 @@
+import hashlib
+import inspect
+import sqlite3
+import sys
+from collections import OrderedDict
+from lexer.lexer import GLOBAL_TABLE
+
+# Modules whose code decides the output of a compile
+SOURCES = ('lexer.symbols', 'lexer.utils', 'lexer.lexer', 'utils.combinators', 'parser.parser', 'parser.grammar')
+
+
+def fingerprint(compiler_type):
+    """
+    Version of the output of compiler_type, a digest of the code of the lexer symbols, grammar and render, changing
+    any of them changes the fingerprint
+    """
+    modules = set(SOURCES)
+    modules.update(cls.__module__ for cls in compiler_type.__mro__ if cls is not object)
+    modules.update(symbol.__module__ for symbols in GLOBAL_TABLE.values() for symbol in symbols)
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(modules):
+        digest.update(name.encode())
+        digest.update(inspect.getsource(sys.modules[name]).encode())
+    # Symbols registered in the table and their order
+    for symbol_type, symbols in GLOBAL_TABLE.items():
+        digest.update(repr((symbol_type.value, [s.__qualname__ for s in symbols])).encode())
+    return digest.hexdigest()
+
+
+class Cache:
+    """
+    Content addressed store of the compile results of compiler_type, keyed by the digest of the text and the
+    fingerprint of the compiler
+
+    Results are kept in memory in least recently used order up to maxsize characters, with path they are also stored
+    in a sqlite database shared across runs. The database holds the results of one fingerprint, it's emptied when
+    opened with a different one. Writes are committed every commit_every results and on close, results lost to a
+    crash in between are compiled again.
+    :param compiler_type: class of the compiler producing the results
+    :param maxsize: characters of results kept in memory
+    :param path: sqlite database file, None keeps results in memory only
+    """
+    commit_every = 256
+
+    def __init__(self, compiler_type, maxsize=2 ** 26, path=None):
+        self.fingerprint = fingerprint(compiler_type)
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lru = OrderedDict()
+        self._db = None
+        self._uncommitted = 0
+        if path is not None:
+            self._db = sqlite3.connect(str(path))
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS meta (fingerprint TEXT)')
+                self._db.execute('CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, value TEXT)')
+                if self._db.execute('SELECT fingerprint FROM meta').fetchone() != (self.fingerprint,):
+                    self._db.execute('DELETE FROM results')
+                    self._db.execute('DELETE FROM meta')
+                    self._db.execute('INSERT INTO meta VALUES (?)', (self.fingerprint,))
+
+    def key(self, text):
+        digest = hashlib.blake2b(text.encode(), digest_size=16)
+        digest.update(self.fingerprint.encode())
+        return digest.digest()
+
+    def get(self, key):
+        """ Result stored under key or None, a result found on disk is kept in memory as well """
+        value = self._lru.get(key)
+        if value is not None:
+            self._lru.move_to_end(key)
+        elif self._db is not None:
+            row = self._db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                value = row[0]
+                self._remember(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self._db is not None:
+            self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?)', (key, value))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self.commit()
+
+    def _remember(self, key, value):
+        if key in self._lru:
+            self.size -= len(self._lru.pop(key))
+        self._lru[key] = value
+        self.size += len(value)
+        while self.size > self.maxsize:
+            _, evicted = self._lru.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self._lru),
+                'size': self.size}
+
+    def commit(self):
+        if self._db is not None:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        if self._db is not None:
+            self.commit()
+            self._db.close()
+            self._db = None
+
+    def __len__(self):
+        return len(self._lru)
@@ -1,7 +1,19 @@
+import asyncio
+import json
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from io import StringIO
+from itertools import islice
 import parser.parser as p
 from enum import Enum
-from lexer.utils import clean
+from lexer.lexer import RedirectFound, IgnoreTags
+from lexer.symbols import BRACKETS, Comment, Heading
+from lexer.utils import clean, Cleaner, MalformedTag, Brackets, Regions
+from utils.budget import Budget, BudgetExceeded
+from utils.combinators import ParseError
 
 
 # from .grammar import Grammar
@@ -11,24 +23,366 @@ class ParseTypes(Enum):
     TEMPLATE = p.TemplateP
 
 
+# Errors of a single article, compile_many hands them back in place of the article result
+ARTICLE_ERRORS = (ParseError, MalformedTag, RedirectFound, BudgetExceeded)
+
+
+# Heading lines, == opens every heading symbol
+HEADING_LINE = re.compile(r'^{0}[^\n]*{0}[ \t]*$'.format(Heading.start.regex), re.M)
+
+
+class NullWriter:
+    """ Writer that drops the text, nodes are walked as in a render without producing any output """
+
+    def write(self, text):
+        return len(text)
+
+
 class Compiler:
-    def __init__(self):
+    """
+    :param cache: cache.Cache of the results of compile, articles are compiled without it while listeners are
+    registered as they wouldn't be notified of the nodes of a cached result
+    """
+
+    def __init__(self, cache=None):
         self.writer = StringIO()
         # self.grammar = Grammar()
         self.parser = p.Parser()
+        self.cache = cache
 
     def render(self, node):
         """ Render function """
         self.writer = StringIO()
         node.compile(self.writer, self.parser)
+        self.parser.flush()
         result = self.writer.getvalue()
         self.writer.close()
         return result
 
-    def compile(self, text):
-        ast = self.parser.parse(text)
+    def compile(self, text, deadline=None, max_tokens=None, max_depth=None):
+        """
+        :param deadline: seconds the lexer and the parser may take
+        :param max_tokens: tokens the parser may read
+        :param max_depth: nesting of links, headings, formatting and list items
+        :raise BudgetExceeded: a limit is passed, it carries the stats of the parse so far
+        """
+        budget = None
+        if deadline is not None or max_tokens is not None or max_depth is not None:
+            budget = Budget(deadline, max_tokens, max_depth)
+        if self.cache is None or self.parser.listening:
+            return self._compile(text, budget)
+        key = self.cache.key(text)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._compile(text, budget)
+            self.cache.put(key, result)
+        return result
+
+    def _compile(self, text, budget=None):
+        ast = self.parser.parse(text, budget=budget)
         # print(ast)
         return clean(self.render(ast))
 
-    def on(self, fn, parse_type):
-        return self.parser.on(fn, parse_type)
+    def stream(self, text, batch=128):
+        """ Same output as compile without building the AST, top level nodes are rendered and listeners notified as
+        the parser reduces them, then they are dropped. Rendering a batch of nodes at a time instead of each one
+        right away is as fast as compile, alternating parser and render code on every node is not """
+        self.writer = StringIO()
+        self._walk(text, self.writer, batch)
+        result = self.writer.getvalue()
+        self.writer.close()
+        return clean(result)
+
+    def compile_to(self, text, sink, batch=128, chunksize=2 ** 16):
+        """ Same output as compile written to sink in chunks, nodes are rendered as in stream and the output is cleaned
+        while it's written, so neither the AST nor the whole output are kept. An article that fails to parse may
+        leave part of its output in sink
+        :param sink: file like object or function called with each chunk
+        :param chunksize: chars rendered before they are cleaned and written
+        :return: number of chars written
+        """
+        write = sink if callable(sink) else sink.write
+        written = 0
+
+        def send(chunk):
+            nonlocal written
+            written += len(chunk)
+            write(chunk)
+
+        cleaner = Cleaner(send, chunksize=chunksize)
+        self._walk(text, cleaner, batch)
+        cleaner.close()
+        return written
+
+    def extract(self, text, types=tuple(ParseTypes), batch=128):
+        """ Nodes of types that compile would notify, in the same order, without rendering the text or cleaning it.
+        Registered listeners are notified as well
+        :return: dict of lists of nodes by type
+        """
+        result = {}
+        offs = [self.parser.on(result.setdefault(parse_type, []).append, parse_type) for parse_type in types]
+        try:
+            self._walk(text, NullWriter(), batch)
+        finally:
+            for off in offs:
+                off()
+        return result
+
+    def structure(self, text, batch=128):
+        """ Clean text, sections, links, categories, media and template names of an article, collected in the walk
+        that renders the text. Nodes are the ones compile renders, links and templates within a link or a heading are
+        not part of them. Registered listeners are notified as well
+        :return: dict with text, sections (title and level of each heading), links (page names), categories (names
+        without sort key), media (file names) and templates (names) in the order they appear
+        """
+        sections, links, categories, media, templates = [], [], [], [], []
+
+        def visit(node):
+            value = node.value
+            if isinstance(node, p.LinkNode):
+                if node.is_media():
+                    media.append(value.evaluate()[0])
+                else:
+                    category = value.category()
+                    if category:
+                        categories.append(category.group().split('|', 1)[0])
+                    else:
+                        links.append(value.evaluate()[0])
+            elif isinstance(node, p.HeadingNode):
+                sections.append(self._section(node))
+            elif isinstance(value, p.TemplateP) and value.start is not None:
+                templates.append(text[value.start:value.end].split('|', 1)[0].strip())
+
+        self.writer = StringIO()
+        self._walk(text, self.writer, batch, visit)
+        result = clean(self.writer.getvalue())
+        self.writer.close()
+        return {'text': result, 'sections': sections, 'links': links, 'categories': categories, 'media': media,
+                'templates': templates}
+
+    @staticmethod
+    def _section(node):
+        title = StringIO()
+        for child in node.children:
+            child.value.render(title)
+        return {'title': clean(title.getvalue()).strip(), 'level': node.level}
+
+    def write_jsonl(self, text, sink, **fields):
+        """ Writes the structure of text to sink as a JSON Lines record, fields are added to the record e.g. the title
+        :param sink: file like object or function called with the line
+        """
+        record = dict(fields)
+        record.update(self.structure(text))
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        (sink if callable(sink) else sink.write)(line)
+        return record
+
+    def _walk(self, text, writer, batch, visit=None):
+        nodes = self.parser.iter_parse(text)
+        while True:
+            chunk = list(islice(nodes, batch))
+            if not chunk:
+                break
+            for node in chunk:
+                node.compile(writer, self.parser, visit)
+        self.parser.flush()
+
+    def compile_many(self, texts, workers=None, chunksize=16, **limits):
+        """ Compiles texts on a pool of processes, each one with its own compiler built once. Results are yielded in
+        the order of texts as they are ready, an article that fails with one of ARTICLE_ERRORS yields the exception.
+        Texts are read lazily, at most two chunks per worker are in flight.
+
+        Listeners registered on this compiler are not called, they live in this process
+        :param texts: iterable of texts
+        :param workers: number of processes, os.cpu_count() by default
+        :param chunksize: texts sent to a worker at a time
+        :param limits: deadline, max_tokens and max_depth of each article as in compile, an article passing one yields
+        BudgetExceeded
+        """
+        workers = workers or os.cpu_count()
+        texts = iter(texts)
+        chunks = iter(lambda: list(islice(texts, chunksize)), [])
+        with ProcessPoolExecutor(workers, initializer=local_compiler, initargs=(type(self),)) as executor:
+            pending = deque(executor.submit(_compile_chunk, type(self), chunk, limits)
+                            for chunk in islice(chunks, 2 * workers))
+            try:
+                while pending:
+                    results = pending.popleft().result()
+                    for chunk in islice(chunks, 1):
+                        pending.append(executor.submit(_compile_chunk, type(self), chunk, limits))
+                    yield from results
+            finally:
+                # Stopped early or failed
+                for future in pending:
+                    future.cancel()
+
+    async def compile_async(self, text, executor=None, **limits):
+        """ Compiles text in executor without blocking the event loop, by default the loop thread pool. Each worker
+        thread or process has its own compiler, cancelling the call cancels the article if it's not running yet.
+        limits are the deadline, max_tokens and max_depth of compile """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, _compile_text, type(self), text, limits)
+
+    async def compile_stream(self, pages, concurrency=4, executor=None, **limits):
+        """ Compiles the texts of an async iterator in executor, as compile_async, yielding the results in order.
+        An article that fails with one of ARTICLE_ERRORS yields the exception, BudgetExceeded for one passing limits.
+
+        At most concurrency articles are in flight, the next page is read only once a result has been taken, so a
+        slow consumer holds back the source. Closing or cancelling the stream cancels the articles not running yet,
+        running ones complete in their worker and are dropped
+        """
+        loop = asyncio.get_running_loop()
+        pages = pages.__aiter__()
+        pending = deque()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < concurrency:
+                    try:
+                        text = await pages.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    pending.append(loop.run_in_executor(executor, _compile_text, type(self), text, limits))
+                if not pending:
+                    break
+                try:
+                    result = await pending[0]
+                except ARTICLE_ERRORS as e:
+                    result = e
+                pending.popleft()
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def sections(self, text):
+        """ Sections of text split at the heading lines, nothing is compiled until a section text is requested """
+        sections = []
+        start, title, level = 0, '', 0
+        protected = iter(_protected(text))
+        region_start, region_end = next(protected, (len(text), len(text)))
+        end = 0
+        for match in HEADING_LINE.finditer(text):
+            position = match.start()
+            while region_start < position:
+                end = max(end, region_end)
+                region_start, region_end = next(protected, (len(text), len(text)))
+            if position < end:
+                continue
+            sections.append(Section(self, text[start:position], title, level, start))
+            line = match.group().rstrip()
+            level = min(len(line) - len(line.lstrip('=')), len(line) - len(line.rstrip('=')), 6)
+            start, title = position, line[level:-level].strip()
+        sections.append(Section(self, text[start:], title, level, start))
+        return Sections(sections)
+
+    def on(self, fn, parse_type, batch=False):
+        return self.parser.on(fn, parse_type, batch)
+
+
+def _protected(text):
+    """ Spans of the templates, links, tables, comments and ignored regions of text sorted by start, a tag never
+    closed runs to the end. A heading line within one isn't a heading of the article """
+    spans = []
+    brackets = Brackets(text, BRACKETS)
+    for tag in BRACKETS:
+        ends = brackets.ends(tag)
+        spans.extend((opening, ends.get(opening, len(text))) for opening in brackets.openings(tag))
+    regions = Regions(text, IgnoreTags.tags + [Comment.start.regex + Regions.content + Comment.end.regex])
+    spans.extend((offset, regions.match(offset).end()) for offset in regions.offsets)
+    spans.sort()
+    return spans
+
+
+class Section:
+    """
+    Section of an article from its heading line to the next one, the lead section has an empty title and level 0
+    :param source: wikitext of the section, heading line included
+    :param start: offset of the section in the article
+    """
+
+    def __init__(self, compiler, source, title, level, start):
+        self.compiler = compiler
+        self.source = source
+        self.title = title
+        self.level = level
+        self.start = start
+        self._text = None
+
+    @property
+    def text(self):
+        """ Compiled on first access and kept """
+        if self._text is None:
+            self._text = self.compiler.compile(self.source)
+        return self._text
+
+    def __repr__(self):
+        return f'Section({self.title!r}, {self.level})'
+
+
+class Sections:
+    """
+    Sections of an article in order, by index or by title, the lead section first.
+
+    Split at heading lines out of templates, links, tables, comments and ignored regions, the renders of the sections
+    joined are the render of the article. Each section is cleaned on its own, the text compile drops for a <ref or a
+    table open at the end of a section may differ
+    """
+
+    def __init__(self, sections):
+        self._sections = sections
+
+    @property
+    def lead(self):
+        return self._sections[0]
+
+    def titles(self):
+        return [section.title for section in self._sections]
+
+    def get(self, title, default=None):
+        """ First section with title """
+        for section in self._sections:
+            if section.title == title:
+                return section
+        return default
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            section = self.get(key)
+            if section is None:
+                raise KeyError(key)
+            return section
+        return self._sections[key]
+
+    def __len__(self):
+        return len(self._sections)
+
+    def __iter__(self):
+        return iter(self._sections)
+
+
+_local = threading.local()
+
+
+def local_compiler(compiler_type):
+    """ Compiler of compiler_type of the current worker, a thread of a pool or a process of a process pool, built on
+    first use """
+    compiler = getattr(_local, 'compiler', None)
+    if type(compiler) is not compiler_type:
+        compiler = _local.compiler = compiler_type()
+    return compiler
+
+
+def _compile_text(compiler_type, text, limits=None):
+    return local_compiler(compiler_type).compile(text, **(limits or {}))
+
+
+def _compile_chunk(compiler_type, texts, limits=None):
+    results = []
+    for text in texts:
+        try:
+            results.append(_compile_text(compiler_type, text, limits))
+        except ARTICLE_ERRORS as e:
+            results.append(e)
+    return results
@@ -0,0 +1,296 @@
+import bz2
+import html
+import os
+import re
+import sqlite3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from xml.etree import ElementTree as etree
+from xml.sax.saxutils import escape
+from compiler import Compiler, ARTICLE_ERRORS, local_compiler
+
+""" Reading of MediaWiki XML dumps, plain XML or pages-articles-multistream.xml.bz2 compiled on a pool of processes """
+
+NAMESPACE = 'http://www.mediawiki.org/xml/export-0.10/'
+
+
+class WikiXML:
+
+    def __init__(self, namespace=NAMESPACE):
+        self._prefix = 'W'
+        self.PAGE = '{0}:page'.format(self._prefix)
+        self.TITLE = '{0}:title'.format(self._prefix)
+        self.TEXT = '{0}:revision/{0}:text'.format(self._prefix)
+        self.ID = '{0}:id'.format(self._prefix)
+
+        self.namespace = namespace
+        self.namespaces = {self._prefix: namespace}
+        self._base_tag = f'{{{namespace}}}' + 'page'
+
+    def from_xml(self, path):
+        """ Page elements of an uncompressed dump, the pages read so far are dropped at each one """
+        context = etree.iterparse(path, events=('start', 'end'))
+        _, dump = next(context)
+        for event, root in context:
+            if event == 'end' and root.tag == self._base_tag:
+                yield root
+                dump.clear()
+
+    def from_stream(self, data):
+        """ Page elements of one stream of a multistream dump, a sequence of pages without the root element. The
+        closing tag of the dump, found in the last stream, is dropped """
+        data = data.split('</mediawiki>', 1)[0]
+        dump = etree.fromstring(f'<mediawiki xmlns="{self.namespace}">{data}</mediawiki>')
+        return dump.iterfind(self.PAGE, self.namespaces)
+
+    def title(self, root):
+        return root.find(self.TITLE, self.namespaces)
+
+    def text(self, root):
+        return root.find(self.TEXT, self.namespaces)
+
+    def id(self, root):
+        return root.find(self.ID, self.namespaces)
+
+    def get(self, root):
+        return self.id(root), self.title(root), self.text(root)
+
+    def record(self, root):
+        """ (id, title, text) of a page as values, a page without text has an empty one """
+        id, title, text = self.get(root)
+        return int(id.text), title.text, text.text or ''
+
+
+class MultistreamDump:
+    """
+    A pages-articles-multistream.xml.bz2 dump and its index. The dump is a sequence of bz2 streams each one
+    decompressed on its own, the first holds the siteinfo and the others about a hundred pages. The index has one
+    offset:id:title line per page, the offset being the one of the stream the page is in, so streams can be read at
+    any point of the file and handed to different processes
+    :param path: dump file
+    :param index: index file, bz2 compressed if it ends with .bz2
+    """
+
+    def __init__(self, path, index):
+        self.path = str(path)
+        self.index = str(index)
+        self._streams = None
+        self._xml = None
+
+    def entries(self):
+        """ (offset, id, title) of each line of the index, titles may contain colons and are XML escaped """
+        opener = bz2.open if self.index.endswith('.bz2') else open
+        with opener(self.index, 'rt', encoding='utf8') as f:
+            for line in f:
+                offset, id, title = line.rstrip('\n').split(':', 2)
+                yield int(offset), int(id), html.unescape(title)
+
+    @property
+    def streams(self):
+        """ (start, end) byte ranges of the streams with pages in dump order, the last one runs to the end of the file
+        and holds the stream closing the dump as well """
+        if self._streams is None:
+            offsets = sorted({offset for offset, _, _ in self.entries()})
+            self._streams = list(zip(offsets, offsets[1:] + [os.path.getsize(self.path)]))
+        return self._streams
+
+    @property
+    def xml(self):
+        """ WikiXML of the namespace declared by the first stream """
+        if self._xml is None:
+            end = self.streams[0][0] if self.streams else os.path.getsize(self.path)
+            match = re.search(r'<mediawiki[^>]*?\sxmlns="([^"]*)"', _decompress(self.path, 0, end))
+            self._xml = WikiXML(match.group(1) if match else NAMESPACE)
+        return self._xml
+
+    def read(self, start, end):
+        """ (id, title, text) of the pages of the stream in start:end """
+        return [self.xml.record(root) for root in self.xml.from_stream(_decompress(self.path, start, end))]
+
+    def pages(self):
+        """ (id, title, text) of each page of the dump in order, read in this process """
+        for start, end in self.streams:
+            yield from self.read(start, end)
+
+    def compile(self, compiler_type=Compiler, workers=None, offset=0, **limits):
+        """
+        Compiles the pages of the dump on a pool of processes, each worker reads, decompresses and parses whole
+        streams and compiles their pages with its own compiler. Yields (id, title, result) in dump order, an article
+        that fails with one of ARTICLE_ERRORS has the exception as result. At most two streams per worker are in
+        flight, only their offsets are sent to the workers
+        :param compiler_type: class of the compiler of the workers
+        :param workers: number of processes, os.cpu_count() by default
+        :param offset: streams starting before offset are skipped
+        :param limits: deadline, max_tokens and max_depth of each article as in Compiler.compile, an article passing
+        one has BudgetExceeded as result
+        """
+        for _, results in self.compile_streams(compiler_type, workers, offset, **limits):
+            yield from results
+
+    def compile_streams(self, compiler_type=Compiler, workers=None, offset=0, **limits):
+        """ As compile, yielding ((start, end), results) once per stream with the results of its pages """
+        workers = workers or os.cpu_count()
+        streams = (stream for stream in self.streams if stream[0] >= offset)
+        namespace = self.xml.namespace
+
+        def submit(executor, stream):
+            return stream, executor.submit(_compile_stream, compiler_type, self.path, namespace, *stream, limits)
+
+        with ProcessPoolExecutor(workers, initializer=local_compiler, initargs=(compiler_type,)) as executor:
+            pending = deque(submit(executor, stream) for stream in islice(streams, 2 * workers))
+            try:
+                while pending:
+                    stream, future = pending.popleft()
+                    results = future.result()
+                    for next_stream in islice(streams, 1):
+                        pending.append(submit(executor, next_stream))
+                    yield stream, results
+            finally:
+                # Stopped early or failed
+                for _, future in pending:
+                    future.cancel()
+
+
+class DumpIndex:
+    """
+    Offsets of the pages of a dump stored in a sqlite file, to read one page without going through the dump. Pages of
+    a multistream dump point to the stream holding them, which is decompressed to find the page, pages of an
+    uncompressed dump to their own bytes.
+
+    The index is built once with build, then opened by path
+    :param path: sqlite file of the index
+    """
+    PAGE = re.compile(rb'^\s*<page>')
+    PAGE_END = re.compile(rb'</page>\s*$')
+    TITLE = re.compile(rb'^\s*<title>(.*)</title>')
+    ID = re.compile(rb'^\s*<id>(\d+)</id>')
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(str(path))
+        meta = self._db.execute('SELECT dump, compressed, namespace FROM meta').fetchone()
+        self.dump, self.compressed, namespace = meta
+        self.xml = WikiXML(namespace)
+
+    @classmethod
+    def build(cls, path, dump, index=None):
+        """
+        Writes the index of dump to path, replacing the one there
+        :param dump: dump file, a multistream one if index is given else uncompressed XML
+        :param index: index file of the multistream dump
+        """
+        if index is not None:
+            multistream = MultistreamDump(dump, index)
+            ends = dict(multistream.streams)
+            pages = ((id, title, offset, ends[offset]) for offset, id, title in multistream.entries())
+            namespace = multistream.xml.namespace
+        else:
+            with open(dump, 'rb') as f:
+                match = re.search(rb'<mediawiki[^>]*?\sxmlns="([^"]*)"', f.read(4096))
+            pages = cls._scan(dump)
+            namespace = match.group(1).decode() if match else NAMESPACE
+        if os.path.exists(path):
+            os.remove(path)
+        with sqlite3.connect(str(path)) as db:
+            db.execute('CREATE TABLE meta (dump TEXT, compressed INTEGER, namespace TEXT)')
+            db.execute('INSERT INTO meta VALUES (?, ?, ?)', (os.path.abspath(dump), index is not None, namespace))
+            db.execute('CREATE TABLE pages (id INTEGER PRIMARY KEY, title TEXT, start INTEGER, end INTEGER)')
+            db.executemany('INSERT INTO pages VALUES (?, ?, ?, ?)', pages)
+            db.execute('CREATE INDEX titles ON pages (title)')
+        db.close()
+        return cls(path)
+
+    @classmethod
+    def _scan(cls, dump):
+        """ (id, title, start, end) of the pages of an uncompressed dump, pages start and end on their own lines as
+        in the dumps. The id is the first one of the page, the one of the revision comes after """
+        with open(dump, 'rb') as f:
+            offset = 0
+            start = id = title = None
+            for line in f:
+                if start is None:
+                    if cls.PAGE.match(line):
+                        start = offset
+                elif id is None and cls.ID.match(line):
+                    id = int(cls.ID.match(line).group(1))
+                elif title is None and cls.TITLE.match(line):
+                    title = html.unescape(cls.TITLE.match(line).group(1).decode('utf8'))
+                offset += len(line)
+                if start is not None and cls.PAGE_END.search(line):
+                    yield id, title, start, offset
+                    start = id = title = None
+
+    def find(self, key):
+        """ (id, title, start, end) of the page with id key, an int, or with title key, None if there's no such page """
+        column = 'id' if isinstance(key, int) else 'title'
+        return self._db.execute(f'SELECT id, title, start, end FROM pages WHERE {column} = ?', (key,)).fetchone()
+
+    def get(self, key):
+        """ (id, title, text) of the page with id or title key, reading only the block of the dump holding it """
+        found = self.find(key)
+        if found is None:
+            return None
+        id, _, start, end = found
+        block = _decompress(self.dump, start, end) if self.compressed else _read(self.dump, start, end)
+        for root in self.xml.from_stream(block):
+            if int(self.xml.id(root).text) == id:
+                return self.xml.record(root)
+        return None
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+
+def _read(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start).decode('utf8')
+
+
+def _decompress(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        # Consecutive streams, as the last one and the closing stream, are decompressed one after the other
+        return bz2.decompress(f.read(end - start)).decode('utf8')
+
+
+def _compile_stream(compiler_type, path, namespace, start, end, limits=None):
+    compiler = local_compiler(compiler_type)
+    xml = WikiXML(namespace)
+    results = []
+    for root in xml.from_stream(_decompress(path, start, end)):
+        id, title, text = xml.record(root)
+        try:
+            results.append((id, title, compiler.compile(text, **(limits or {}))))
+        except ARTICLE_ERRORS as e:
+            results.append((id, title, e))
+    return results
+
+
+def write_multistream(pages, path, index, per_stream=100, namespace=NAMESPACE):
+    """
+    Writes pages as a multistream dump and its bz2 index, laid out as the ones of the Wikimedia downloads with
+    per_stream pages in each stream
+    :param pages: iterable of (id, title, text)
+    """
+    pages = iter(pages)
+    lines = []
+    with open(path, 'wb') as f:
+        f.write(bz2.compress(f'<mediawiki xmlns="{namespace}" version="0.10" xml:lang="en">\n'
+                             f'  <siteinfo>\n  </siteinfo>\n'.encode('utf8')))
+        for chunk in iter(lambda: list(islice(pages, per_stream)), []):
+            offset = f.tell()
+            xml = []
+            for id, title, text in chunk:
+                # Titles of the index are escaped as in the XML of the dump, quotes as well
+                lines.append(f'{offset}:{id}:' + escape(title, {'"': '&quot;'}) + '\n')
+                xml.append(f'  <page>\n    <title>{escape(title)}</title>\n    <ns>0</ns>\n    <id>{id}</id>\n'
+                           f'    <revision>\n      <text xml:space="preserve">{escape(text)}</text>\n'
+                           f'    </revision>\n  </page>\n')
+            f.write(bz2.compress(''.join(xml).encode('utf8')))
+        f.write(bz2.compress(b'</mediawiki>\n'))
+    with bz2.open(index, 'wt', encoding='utf8') as f:
+        f.writelines(lines)
@@ -26,15 +26,13 @@ def extract_links():
     outputFile = (outputsDir / 'wikitext_link_extraction.txt').open(encoding="utf8", mode="w")
     with (ROOT / 'examples/data/wikitext_link_extraction.txt').open(encoding="utf8") as f:
         w_compiler = c.Compiler()
-        listener = w_compiler.on(lambda node: parse_link(node), c.ParseTypes.LINK)
         text = f.read()
         try:
-            w_compiler.compile(text)
+            for node in w_compiler.extract(text, [c.ParseTypes.LINK])[c.ParseTypes.LINK]:
+                parse_link(node)
             outputFile.write(f'\n\n* Links\n\n {reverse_graph} \n\n* Categories\n {categories}'),
         except Exception as e:
             traceback.print_exc()
-        finally:
-            listener()  # free listener
 
 
 if __name__ == '__main__':
@@ -1,11 +1,12 @@
 import logging
 import re
+from array import array
 from enum import Enum
 from lexer.symbols import Template, Link, Text, Token, Redirect, \
-    Comment, IGNORED_TAGS, LineBreak, Heading, Heading4, Heading3, Heading5, Heading6, \
+    Comment, IGNORED_TAGS, BRACKETS, WIKIMEDIA_MARKUP, LineBreak, Heading, Heading4, Heading3, Heading5, Heading6, \
     Italic, ItalicAndBold, Bold, List
 
-from .utils import RecursiveMatch, recursive
+from .utils import RecursiveMatch, Brackets, Markup, Regions, Span
 
 logger = logging.getLogger('lexer')
 
@@ -28,11 +29,16 @@ class Symbol(Enum):
 
 
 class LexerToken(Token):
-    def __init__(self, token, row, col, text=''):
+    """
+    Token found by the lexer, it's a span over the source text and the text is sliced only when requested
+    """
+    __slots__ = ('_token', '_source', '_start', '_end')
+
+    def __init__(self, token, source, start, end):
         self._token = token
-        self._row = row
-        self._col = col
-        self._text = text
+        self._source = source
+        self._start = start
+        self._end = end
 
         # TODO call super()
 
@@ -40,17 +46,29 @@ class LexerToken(Token):
     def token(self):
         return self._token
 
+    @property
+    def source(self):
+        return self._source
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def end(self):
+        return self._end
+
     @property
     def text(self):
-        return self._text
+        return self._source[self._start:self._end]
 
     def __repr__(self):
         # return self._text + '\n'
         return self.__str__()
 
     def __str__(self):
-        return self._token.__repr__() + f' [{self._col}]'
-        # return '\n' + self._text + ' ' + str(self._col)
+        return self._token.__repr__() + f' [{self._start}]'
+        # return '\n' + self._text + ' ' + str(self._start)
 
     def __eq__(self, token):
         return self._token == token
@@ -59,9 +77,79 @@ class LexerToken(Token):
         return not self.__eq__(token)
 
 
+class ContentToken(LexerToken):
+    """
+    Content of a recursive tag, the text is the span without the nested tags
+    """
+    __slots__ = ('_nested',)
+
+    def __init__(self, token, source, start, end, nested):
+        super().__init__(token, source, start, end)
+        self._nested = nested
+
+    @property
+    def nested(self):
+        return self._nested
+
+    @property
+    def text(self):
+        return self._nested.sub('', self._source[self._start:self._end])
+
+
 class EOFToken(LexerToken):
-    def __init__(self, row, col):
-        super().__init__(Lexer.EOF, row, col)
+    __slots__ = ()
+
+    def __init__(self, source, pos):
+        super().__init__(Lexer.EOF, source, pos, pos)
+
+
+class TokenStream:
+    """
+    Compact sequence of tokens, each token is a kind id and a (start, end) span over the source kept in parallel
+    arrays. Tokens are handed out as LexerToken views built on access
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self._kinds = []
+        self._ids = {}
+        self._kind = array('H')
+        self._start = array('i')
+        self._end = array('i')
+        self._nested = {}
+
+    def append(self, token):
+        kind = self._ids.get(id(token.token))
+        if kind is None:
+            kind = self._ids[id(token.token)] = len(self._kinds)
+            self._kinds.append(token.token)
+        if isinstance(token, ContentToken):
+            self._nested[len(self._kind)] = token.nested
+        self._kind.append(kind)
+        self._start.append(token.start)
+        self._end.append(token.end)
+
+    def __len__(self):
+        return len(self._kind)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        token = self._kinds[self._kind[index]]
+        if token == Lexer.EOF:
+            return EOFToken(self.source, self._start[index])
+        if index in self._nested:
+            return ContentToken(token, self.source, self._start[index], self._end[index], self._nested[index])
+        return LexerToken(token, self.source, self._start[index], self._end[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 """
@@ -75,6 +163,60 @@ GLOBAL_TABLE = {
 }
 
 
+class Scanner:
+    """
+    Master regex scanner over a list of symbols
+
+    Every symbol is compiled into a single alternation with one named group per symbol, so finding the symbol that
+    matches at a position costs one regex call instead of one call per symbol. A pass of the lexer tries the symbols
+    in table order and keeps going from the symbol after the last one matched, hence an alternation is compiled for
+    every suffix of the table.
+    A symbol can take part only if it has a start and end token and matches nowhere its tokens don't, the symbol match
+    is still called on the candidate found so custom logic (recursion, context) is preserved.
+    """
+
+    def __init__(self, symbols):
+        self.symbols = symbols
+        self._masters = [self.__compile(i) for i in range(len(symbols))] + [None]
+
+    @staticmethod
+    def supports(symbols):
+        return all(isinstance(getattr(s, 'start', None), Token) and isinstance(getattr(s, 'end', None), Token)
+                   for s in symbols)
+
+    @staticmethod
+    def __pattern(token):
+        flags = ''.join(f for f, v in (('i', re.I), ('m', re.M), ('s', re.S), ('x', re.X)) if token.re.flags & v)
+        return '(?{0}:{1})'.format(flags, token.regex) if flags else '(?:{0})'.format(token.regex)
+
+    def __compile(self, first):
+        groups = []
+        for index in range(first, len(self.symbols)):
+            symbol = self.symbols[index]
+            tokens = [symbol.start] if symbol.start.regex == symbol.end.regex else [symbol.start, symbol.end]
+            groups.append('(?P<s{0}>{1})'.format(index, '|'.join(self.__pattern(t) for t in tokens)))
+        return re.compile('|'.join(groups))
+
+    def match(self, text, pos, first=0):
+        """
+        Match the first symbol, starting from the symbol at index first, that matches at pos
+        :param text:
+        :param pos:
+        :param first: index of the first symbol to try
+        :return: (index of the next symbol to try, match, token) or (None, None, None)
+        """
+        while self._masters[first] is not None:
+            candidate = self._masters[first].match(text, pos)
+            if candidate is None:
+                break
+            index = int(candidate.lastgroup[1:])
+            match, token = self.symbols[index].match(text, pos)
+            if match:
+                return index + 1, match, token
+            first = index + 1
+        return None, None, None
+
+
 class Lexer:
     """
     Lexer that handles streams of character and delivers tokens
@@ -82,18 +224,25 @@ class Lexer:
 
     EOF = Token('EOF')
 
-    def __init__(self, encoder=Encoder()):
+    def __init__(self, encoder=Encoder(), scanner=True):
+        """
+        :param encoder:
+        :param scanner: match the reserved symbols through a master regex Scanner, False tries them one at a time
+        """
         self._row = 0  # Not used yet
         self._col = 0
         self.encoder = encoder
-        self.tokens = list()
+        self.tokens = TokenStream('')
         self.last_token = None
+        self._indexes = {}
         self.table = {
             Symbol.RESERVED: [],
             Symbol.IGNORE: [],
             Symbol.ID: []
         }
         self.__create_table()
+        self.scanner = Scanner(self.table[Symbol.RESERVED]) \
+            if scanner and Scanner.supports(self.table[Symbol.RESERVED]) else None
 
         # for index, s in enumerate(self.table[Symbol.RESERVED]):
         #     setattr(s, 'lexer', self)
@@ -110,69 +259,116 @@ class Lexer:
                 setattr(inst, 'lexer', self)
                 self.table[k].append(inst)
 
-    def _tokenize(self, text, symbol_type):
+    def _tokenize(self, text, match, token, tokens):
+        """
+        Appends the tokens of a symbol match to tokens
+        :return: end of the match
+        """
+        # Find a better way to do it
+        if isinstance(match, RecursiveMatch):
+            for (t, start, end) in match.matches:
+                tokens.append(
+                    LexerToken(t, text, start, end) if t is not None
+                    else ContentToken(TextT.start, text, start, end, match.nested))
+            return match.end(0)
+
+        end = match.end(0)
+        tokens.append(LexerToken(token, text, match.start(0), end))
+        return end
+
+    def _index(self, text, name, build):
         """
-        Tokenizer
+        Index of text built on the first request and kept until the next text
         :param text:
-        :param symbol_type:
+        :param name: index name
+        :param build: index constructor, called with the text
         :return:
         """
-        text = self.encoder.encode(text)
-        tokens = []
+        index = self._indexes.get(name)
+        if index is None or index.text is not text:
+            index = self._indexes[name] = build(text)
+        return index
 
-        # Debugging
-        # if symbol_type == Symbol.ID: breakpoint()
-        for symbol in self.table[symbol_type]:
-            # try:
-            match, token = symbol.match(text, self._col)
-            # Find a better way to do it
-            if match:
-                if isinstance(match, RecursiveMatch):
-                    for (m, t) in match.matches:
-                        tokens.append(
-                            LexerToken(t if isinstance(t, Token) else TextT.start,
-                                       self._row,
-                                       self._col,
-                                       m.group(0)))
+    def brackets(self, text):
+        """ Matching pairs of the recursive tags """
+        return self._index(text, 'brackets', lambda t: Brackets(t, BRACKETS))
 
-                else:
-                    tokens.append(LexerToken(token, self._row, self._col, match.group(0)))
+    def regions(self, text):
+        """ Regions enclosed by the ignored tags """
+        return self._index(text, 'regions', lambda t: Regions(t, IgnoreTags.tags))
 
-                self._col = match.end(0)
-            # except MalformedTag as e:
+    def markup(self, text):
+        """ Offsets where text stops, a markup delimiter or an ignored region """
+        return self._index(text, 'markup', lambda t: Markup(t, WIKIMEDIA_MARKUP, self.regions(t).offsets))
 
-        if len(tokens) == 0 and symbol_type == Symbol.ID:
-            self._col += 1
-
-        if self._col >= len(text):
-            return tokens, None
+    def _pass(self, text, symbol_type):
+        """
+        One pass over the symbols of symbol_type starting at the current column, a symbol is tried at the column left by
+        the previous match
+        :param text:
+        :param symbol_type:
+        :return: tokens
+        """
+        tokens = []
+        if symbol_type == Symbol.RESERVED and self.scanner is not None:
+            index = 0
+            while index is not None:
+                index, match, token = self.scanner.match(text, self._col, index)
+                if match:
+                    self._col = self._tokenize(text, match, token, tokens)
+        else:
+            for symbol in self.table[symbol_type]:
+                match, token = symbol.match(text, self._col)
+                if match:
+                    self._col = self._tokenize(text, match, token, tokens)
+        return tokens
 
-        return tokens, Symbol.RESERVED if len(tokens) > 0 else Symbol.ID
+    def iter_tokens(self, text):
+        """
+        Tokens generator, text is lexed on demand as the tokens are consumed and the last token is always the EOF.
+        RedirectFound and MalformedTag are raised when the lexer reaches them
 
-    def tokenize(self, text):
-        self.tokens = list()
+        Lexing is linear in the text length: every iteration moves the column forward, tokens are handed out as soon
+        as they are resolved instead of being accumulated and the encoder runs once per text.
+        :param text:
+        :return: generator of LexerToken
+        """
+        text = self.encoder.encode(text)
+        self._indexes = {}
         self.last_token = None
         self._col = 0
         symbol_type = Symbol.RESERVED
 
-        while self._col < len(text):
-            for ignore in self.table[Symbol.IGNORE]:
+        ignores = self.table[Symbol.IGNORE]
+        length = len(text)
+        while self._col < length:
+            for ignore in ignores:
                 match = ignore.match(text, self._col)
                 if match:
                     # print(match, text[match.start(0):match.end(0)])
                     self._col = match.end(0)
+
+            tokens = self._pass(text, symbol_type)
+            if tokens:
+                self.last_token = tokens[-1]
+                yield from tokens
+                symbol_type = Symbol.RESERVED
+            elif symbol_type == Symbol.ID:
+                self._col += 1
             else:
-                resolved_tokens, next_symbol = self._tokenize(text, symbol_type)
-                symbol_type = next_symbol
-                self.tokens = self.tokens + resolved_tokens
-                self.last_token = self.tokens[-1] if len(self.tokens) else None
-                if symbol_type is None:
-                    break
-
-        self.tokens.append(EOFToken(self._row, self._col))
-        logger.info(self.tokens)
-        logger.info('EOF')
+                symbol_type = Symbol.ID
+
+        eof = EOFToken(text, self._col)
         self._col += 1
+        yield eof
+
+    def tokenize(self, text):
+        self.tokens = TokenStream(text)
+        for token in self.iter_tokens(text):
+            self.tokens.append(token)
+        logger.info('%d tokens', len(self.tokens))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(self.tokens)
         return self.tokens
 
     # def __new__(cls, *args, **kwargs):
@@ -214,7 +410,7 @@ class TemplateT(Template):
         super().__init__()
 
     def match(self, text, pos, **kwargs):
-        return recursive(text, self.start, self.end, pos), self.start
+        return self.lexer.brackets(text).match(self.start, self.end, pos), self.start
 
 
 # Lexer.symbol(Symbol.RESERVED)(Link)
@@ -283,15 +479,19 @@ definition(Symbol.RESERVED)(LineBreak)
 
 @definition(Symbol.IGNORE)
 class IgnoreTags:
+    """
+    Tags whose content is skipped, each tag is expected in the form: opening, lazy content, closing.
+    The regions they enclose are looked up in the lexer Regions index
+    """
     # start = Token('MATH_JAX_START', r'<math')
     # end = Token('MATH_JAX_END', r'')
     tags = [] + IGNORED_TAGS
 
     def __init__(self):
-        self.regex = re.compile('|'.join(self.tags), re.DOTALL)
+        pass
 
     def match(self, text, pos, **kwargs):
-        return self.regex.match(text, pos, **kwargs)
+        return self.lexer.regions(text).match(pos)
 
 
 @definition(Symbol.ID)
@@ -304,6 +504,15 @@ class TextT(Text):
     def __init__(self):
         super().__init__()
 
+    def match(self, text, pos, **kwargs):
+        """
+        Text goes on up to the next markup delimiter or ignored region, the same stop of the Text lookahead regex
+        found in the lexer Markup index
+        """
+        if pos >= len(text):
+            return None, self.start
+        return Span(pos, self.lexer.markup(text).next(pos + 1)), self.start
+
 
 # @Lexer.symbol(Symbol.IGNORE)
 class Ignore:
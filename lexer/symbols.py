@@ -10,6 +10,7 @@ class Token:
     """
     Basic token
     """
+    __slots__ = ('_tag', '_regex', '_match')
 
     def __init__(self, tag, regex='', flags=0):
         self._tag = tag
@@ -216,6 +217,13 @@ WIKIMEDIA_MARKUP = [
     # useful for indexing purpose
 ]
 
+# Recursive tags, their pairs are matched once per text
+BRACKETS = [
+    Template(),
+    Link(),
+    Table()
+]
+
 IGNORED_TAGS = [
     r'<math[\s\S]*?<\/math\>',
     r'<\!--[\s\S]*?--\>',
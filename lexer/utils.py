@@ -1,12 +1,22 @@
 import re
+from array import array
+from bisect import bisect_left
 import lexer.symbols as s
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 """ Recursive match helper that regular expressions can't handle """
 
+ESCAPES = {'n': '\n', 'r': '\r', 't': '\t', 'f': '\f', 'v': '\v'}
+
 
 class MalformedTag(Exception):
     def __init__(self, start, end, position):
         self.type = 'MalformedTag'
+        self.position = position
         self.message = f"Malformed tag found: {start} {end} {position}"
 
 
@@ -16,7 +26,6 @@ def recursive(text, start, end, position):
     text_match = re.compile(r'.*?(?={0}|{1})'.format(start.regex, end.regex), re.DOTALL)
     stack = []
     index = position
-    content = ''
     should_start = start.match(text, index)
     last_end = None
 
@@ -36,7 +45,6 @@ def recursive(text, start, end, position):
                 last_end = is_end
 
             elif txt:
-                content += txt.group(0)
                 index = txt.end()
             else:
                 """
@@ -47,20 +55,35 @@ def recursive(text, start, end, position):
 
             if not stack:
                 rec = RecursiveMatch(should_start.start(), index, [
-                    (should_start, start),
-                    (re.match(r'.*', content, re.DOTALL), content),
-                    (last_end, end)])
+                    (start, should_start.start(), should_start.end()),
+                    (None, should_start.end(), last_end.start()),
+                    (end, last_end.start(), last_end.end())],
+                    re.compile('{0}|{1}'.format(start.regex, end.regex)))
 
                 return rec
     return None
 
 
+class Span:
+    # Can't subclass re.Match
+    def __init__(self, start, end):
+        self._start = start
+        self._end = end
+
+    def end(self, group=0):
+        return self._end
+
+    def start(self, group=0):
+        return self._start
+
+
 class RecursiveMatch:
     # Can't subclass re.Match
-    def __init__(self, start, end, matches):
+    def __init__(self, start, end, matches, nested):
         self._start = start
         self._end = end
         self._matches = matches
+        self._nested = nested
 
     def end(self, pos=0):
         return self._end
@@ -70,31 +93,570 @@ class RecursiveMatch:
 
     @property
     def matches(self):
+        """ Spans (token, start, end) of the opening tag, the content and the closing tag, content has no token """
         return self._matches
 
+    @property
+    def nested(self):
+        """ Regex of the nested tags to strip out of the content """
+        return self._nested
+
+
+def head(regex):
+    """ First character matched by a regex that starts with a literal, None otherwise """
+    if regex[:1] == '\\':
+        char = regex[1:2]
+        return ESCAPES.get(char) if char.isalnum() else char or None
+    return None if not regex or regex[0] in '.^$*+?[()|' else regex[0]
+
+
+def literal(regex):
+    """ Text matched by a regex made only of literal characters, None otherwise """
+    chars = []
+    pieces = re.findall(r'\\.|.', regex, re.DOTALL)
+    for index, piece in enumerate(pieces):
+        if piece[0] == '\\':
+            char = ESCAPES.get(piece[1]) if piece[1].isalnum() else piece[1]
+        elif piece in '.^$*+?[()|' or piece == '{' and index + 1 < len(pieces) and pieces[index + 1].isdigit():
+            char = None
+        else:
+            char = piece
+        if char is None:
+            return None
+        chars.append(char)
+    text = ''.join(chars)
+    return text if text and re.fullmatch(regex, text) else None
+
+
+def find(codes, text):
+    """ Offsets of text, overlapping ones included, in the code points array of a string """
+    size = len(codes) - len(text) + 1
+    if size <= 0:
+        return np.empty(0, dtype=np.int64)
+    mask = codes[:size] == ord(text[0])
+    for offset, char in enumerate(text[1:], 1):
+        mask &= codes[offset:offset + size] == ord(char)
+    return np.flatnonzero(mask)
+
+
+def code_points(text):
+    return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+
+def lookahead(tokens, flags=0):
+    """ Regex matching, without consuming, at every offset where a token matches, one group per token """
+    heads = [head(token.regex) for token in tokens]
+    first = '(?=[{0}])'.format(''.join(sorted({re.escape(h) for h in heads}))) if None not in heads else ''
+    return re.compile('{0}(?={1})'.format(first, '|'.join('({0})'.format(t.regex) for t in tokens)), flags)
+
+
+class Brackets:
+    """
+    Matching pairs of the recursive tags of a text
+
+    Every tag of every kind is found with a single regex pass and paired with a stack per kind, hence matching a tag
+    is a lookup instead of a scan of its content. Tags are literals, a tag overlapping the previous one of the same
+    kind is skipped the same way a left to right scan does.
+
+    Texts longer than vectorize chars are paired with numpy, when it's installed, from the nesting depth of the tags.
+    """
+    vectorize = 8000
+
+    def __init__(self, text, tags):
+        self.text = text
+        self._kinds = {tag.start.regex: index for index, tag in enumerate(tags)}
+        self._nested = [re.compile('{0}|{1}'.format(tag.start.regex, tag.end.regex)) for tag in tags]
+        self._pairs = [{} for _ in tags]
+        self._openings = [[] for _ in tags]
+        self._unmatched = [[] for _ in tags]
+        if np is None or len(text) < self.vectorize or not self.__index_vectorized(tags):
+            self.__index(tags)
+
+    def __index(self, tags):
+        regex = lookahead([token for tag in tags for token in (tag.start, tag.end)])
+        stacks = [[] for _ in tags]
+        last = [-1] * len(tags)
+
+        for match in regex.finditer(self.text):
+            group = match.lastindex
+            kind, is_end = divmod(group - 1, 2)
+            position = match.start()
+            if position < last[kind]:
+                continue
+            last[kind] = position + len(match.group(group))
+
+            if not is_end:
+                stacks[kind].append((position, last[kind]))
+                self._openings[kind].append(position)
+            elif stacks[kind]:
+                opening, opening_end = stacks[kind].pop()
+                self._pairs[kind][opening] = (opening_end, position, last[kind])
+            else:
+                self._unmatched[kind].append(position)
+
+        for kind, stack in enumerate(stacks):
+            self._unmatched[kind] = sorted(self._unmatched[kind] + [opening for opening, _ in stack])
+
+    def __index_vectorized(self, tags):
+        """
+        Tags are found comparing the code points of the text, a tag overlapping the previous one is skipped only if the
+        previous one is kept, so along a run of overlapping tags every other tag is kept.
+        The depth after each tag is the cumulative sum of +1 (opening) and -1 (closing), floored at 0 since a closing
+        tag with nothing open is ignored. An opening tag at depth d and its closing tag are the only tags at level d
+        between them, so sorting the tags by level keeps each pair next to each other
+        :return: False when tags aren't literals or overlap more than the previous tag, nothing is indexed
+        """
+        delimiters = [(literal(tag.start.regex), literal(tag.end.regex)) for tag in tags]
+        if any(opening is None or closing is None for opening, closing in delimiters):
+            return False
+
+        codes = code_points(self.text)
+        kinds = []
+        for opening, closing in delimiters:
+            openings, closings = find(codes, opening), find(codes, closing)
+            start = np.concatenate((openings, closings))
+            step = np.concatenate((np.ones(len(openings), np.int64), np.full(len(closings), -1, np.int64)))
+            order = np.argsort(start, kind='stable')
+            start, step = start[order], step[order]
+            end = start + np.where(step > 0, len(opening), len(closing))
+            if np.any(start[1:] == start[:-1]) or np.any(start[2:] < end[:-2]):
+                return False
+
+            overlap = np.concatenate(([False], start[1:] < end[:-1]))
+            runs = np.flatnonzero(~overlap)
+            kept = (np.arange(len(start)) - runs[np.cumsum(~overlap) - 1]) % 2 == 0
+            kinds.append((start[kept], end[kept], step[kept]))
+
+        for kind, (start, end, step) in enumerate(kinds):
+            total = np.cumsum(step)
+            floor = np.minimum.accumulate(np.minimum(total, 0))
+            stray = floor < np.concatenate(([0], floor[:-1]))
+            depth = total - floor
+            level = np.where(step > 0, depth, depth + 1)
+
+            kept = np.flatnonzero(~stray)
+            order = kept[np.lexsort((kept, level[kept]))]
+            left, right = order[:-1], order[1:]
+            paired = (step[left] > 0) & (step[right] < 0) & (level[left] == level[right])
+            partner = np.full(len(step), -1)
+            partner[left[paired]] = right[paired]
+
+            openings = np.flatnonzero(step > 0)
+            closings = partner[openings]
+            matched = closings >= 0
+            self._pairs[kind] = PairArrays(start[openings[matched]], end[openings[matched]],
+                                           start[closings[matched]], end[closings[matched]])
+            self._openings[kind] = start[openings].tolist()
+            self._unmatched[kind] = sorted(start[openings[~matched]].tolist() + start[stray].tolist())
+        return True
+
+    def openings(self, tag):
+        """ Offsets of the opening tags, matched or not, in text order """
+        return self._openings[self._kinds[tag.start.regex]]
+
+    def unbalanced(self, tag):
+        """ Offsets of the opening tags never closed and of the closing tags never opened """
+        return self._unmatched[self._kinds[tag.start.regex]]
+
+    def ends(self, tag):
+        """ End of the closing tag of every opening tag matched, by offset of the opening """
+        return {opening: pair[2] for opening, pair in self._pairs[self._kinds[tag.start.regex]].items()}
+
+    def match(self, start, end, position):
+        """
+        Same as recursive, the tag at position is looked up in the index
+        :raise MalformedTag: the tag at position is never closed
+        """
+        kind = self._kinds[start.regex]
+        pair = self._pairs[kind].get(position)
+        if pair is None:
+            if start.match(self.text, position) and position in self._unmatched[kind]:
+                raise MalformedTag(start, end, position)
+            # Not an opening tag of the index
+            return recursive(self.text, start, end, position)
+
+        opening_end, closing, closing_end = pair
+        return RecursiveMatch(position, closing_end, [
+            (start, position, opening_end),
+            (None, opening_end, closing),
+            (end, closing, closing_end)],
+            self._nested[kind])
+
+
+class PairArrays:
+    """ Pairs of one kind of tag kept in arrays sorted by opening offset """
+
+    def __init__(self, openings, opening_ends, closings, closing_ends):
+        self.openings = openings
+        self.opening_ends = opening_ends
+        self.closings = closings
+        self.closing_ends = closing_ends
+
+    def get(self, position):
+        index = int(np.searchsorted(self.openings, position))
+        if index < len(self.openings) and self.openings[index] == position:
+            return int(self.opening_ends[index]), int(self.closings[index]), int(self.closing_ends[index])
+        return None
+
+    def items(self):
+        """ (opening, pair) of every pair as the dict of the python index """
+        return zip(self.openings.tolist(), zip(self.opening_ends.tolist(), self.closings.tolist(),
+                                               self.closing_ends.tolist()))
+
+
+class Markup:
+    """
+    Offsets of a text where a markup delimiter starts, overlapping delimiters included, found with a single regex pass.
+    Texts longer than vectorize chars are searched with numpy, when it's installed and delimiters are literals
+    """
+    vectorize = 8000
+
+    def __init__(self, text, tags, offsets=()):
+        """
+        :param text:
+        :param tags: markup tags
+        :param offsets: other offsets to merge in, e.g. the Regions ones
+        """
+        self.text = text
+        tokens = []
+        for tag in tags:
+            for token in (tag.start, tag.end):
+                if token.regex not in [t.regex for t in tokens]:
+                    tokens.append(token)
+
+        literals = [literal(token.regex) for token in tokens]
+        if np is not None and len(text) >= self.vectorize and None not in literals:
+            codes = code_points(text)
+            found = np.unique(np.concatenate([find(codes, text) for text in literals] +
+                                             [np.array(offsets, dtype=np.int64)]))
+            # Looked up one at a time, bisect on an array is cheaper than a numpy call
+            self.offsets = array('q', found.astype(np.int64).tobytes())
+        else:
+            found = (match.start() for match in lookahead(tokens).finditer(text))
+            self.offsets = array('q', sorted(set(found).union(offsets)) if offsets else found)
+
+    def next(self, position):
+        """ First delimiter offset at or after position, the length of the text when there is none """
+        index = bisect_left(self.offsets, position)
+        return self.offsets[index] if index < len(self.offsets) else len(self.text)
+
+
+class Regions:
+    """
+    Regions of a text enclosed by tags in the form: opening, lazy content, closing
+
+    The openings of every tag are found with a single regex pass and the closings of a tag with a pass only if the tag
+    is ever opened, a region starts at an opening and ends at the first closing after it, instead of scanning the
+    content after every opening looking for its closing. Tags in other forms are matched as they are at every offset
+    """
+    content = r'[\s\S]*?'
+
+    def __init__(self, text, tags):
+        self.text = text
+        self._ends = {}
+        delimiters = []
+        for tag in tags:
+            parts = tag.split(self.content)
+            opening = literal(parts[0]) if len(parts) == 2 else None
+            delimiters.append((opening, parts[-1]) if opening is not None else None)
+
+        openings = [[] for _ in tags]
+        if any(delimiters):
+            regex = lookahead([s.Token('OPENING', re.escape(d[0])) for d in delimiters if d is not None])
+            for match in regex.finditer(text):
+                for index, delimiter in enumerate(delimiters):
+                    if delimiter is not None and text.startswith(delimiter[0], match.start()):
+                        openings[index].append(match.start())
+
+        for index, tag in enumerate(tags):
+            regions = self.__regions(openings[index], *delimiters[index]) if delimiters[index] is not None \
+                else [match.span(1) for match in lookahead([s.Token('REGION', tag)], re.DOTALL).finditer(text)]
+            for start, end in regions:
+                self._ends.setdefault(start, end)
+        self.offsets = sorted(self._ends)
+
+    def __regions(self, openings, opening, closing):
+        if not openings:
+            return []
+
+        closings = [match.span(1) for match in lookahead([s.Token('CLOSING', closing)], re.DOTALL).finditer(self.text)]
+        starts = [start for start, _ in closings]
+        regions = []
+        for start in openings:
+            index = bisect_left(starts, start + len(opening))
+            if index < len(closings):
+                regions.append((start, closings[index][1]))
+        return regions
+
+    def match(self, position):
+        """ Region starting at position, None if there's none """
+        end = self._ends.get(position)
+        return Span(position, end) if end is not None else None
+
+
+# Quotes of the formatting tags, removing every Bold, then ItalicAndBold and Italic tag leaves only the last quote of
+# a run of 3k + 1 quotes
+QUOTES = re.compile(r"\'(?:\'\'\')*\'(?!\')|\'\'\'(?:\'\'\')*")
+
+
+def _find(text, sub, start):
+    position = text.find(sub, start)
+    return position if position >= 0 else None
+
+
+def refs(text):
+    """
+    Drops the refs of a text, same as re.sub(r'<ref[\\s\\S]*?\\/\\>(!?<\\/ref\\>)*|<ref[\\s\\S]*?\\>*?[<]?\\/ref\\>', '', text)
+    A ref runs from <ref to the first /> after it followed by any </ref> or !</ref>, or without a /> to the first
+    /ref>. The regex looks for them from every <ref, up to the end of the text when there's none, the next /> and
+    /ref> are found once here and reused by the refs before them
+    """
+    chunks = []
+    last = 0
+    slash = closing = -1
+    position = text.find('<ref')
+    while position >= 0:
+        body = position + 4
+        if slash is not None and slash < body:
+            slash = _find(text, '/>', body)
+        if slash is None and closing is not None and closing < body:
+            closing = _find(text, '/ref>', body)
+
+        if slash is not None:
+            end = slash + 2
+            while True:
+                if text.startswith('</ref>', end):
+                    end += 6
+                elif text.startswith('!</ref>', end):
+                    end += 7
+                else:
+                    break
+        elif closing is not None:
+            end = closing + 5
+        else:
+            break
+        chunks.append(text[last:position])
+        last = end
+        position = text.find('<ref', end)
+    chunks.append(text[last:])
+    return ''.join(chunks)
+
 
 def clean(text, keep_tables=False):
-    tags = [
-        s.Bold,
-        s.ItalicAndBold,
-        s.Italic,
-    ]
-
-    for i in tags:
-        text = re.sub(i.start.regex, "", text)
-
-    if not keep_tables:
-        is_there = s.Table.start.re.search(text)
-        while is_there is not None:
+    """
+    Drops the formatting quotes, the tables unless keep_tables and the refs of a rendered text. Steps run in this
+    order since each one sees the text left by the previous one, e.g. quotes between { and | make a table. Every step
+    is a single linear pass and it's skipped when the text has none of its tags
+    """
+    text = QUOTES.sub('', text)
+
+    if not keep_tables and '{|' in text:
+        brackets = Brackets(text, [s.Table])
+        chunks = []
+        last = 0
+        for opening in brackets.openings(s.Table):
+            if opening < last:
+                continue
             try:
-                match = recursive(text, s.Table.start, s.Table.end, is_there.start())
-                text = text[:match.start()] + ' ' + text[match.end():]
-                is_there = s.Table.start.re.search(text)
+                match = brackets.match(s.Table.start, s.Table.end, opening)
             except MalformedTag as e:
                 print(e.message)
                 break
+            chunks.append(text[last:match.start()])
+            chunks.append(' ')
+            last = match.end()
+        chunks.append(text[last:])
+        text = ''.join(chunks)
 
-    text = re.sub(r'<ref[\s\S]*?\/\>(!?<\/ref\>)*|<ref[\s\S]*?\>*?[<]?\/ref\>', "", text)
+    if '<ref' in text:
+        text = refs(text)
     # text = re.sub(r'\*', "", text)
 
     return text
+
+
+class _Quotes:
+    """ Quotes step of Cleaner, a run of quotes at the end of a text is held as it may go on in the next one """
+
+    def __init__(self, out):
+        self._out = out
+        self._tail = ''
+
+    def write(self, text):
+        text = self._tail + text
+        cut = len(text.rstrip("'"))
+        self._tail = text[cut:]
+        if cut:
+            self._out.write(QUOTES.sub('', text[:cut]))
+
+    def close(self):
+        self._out.write(QUOTES.sub('', self._tail))
+        self._tail = ''
+        self._out.close()
+
+
+class _Tables:
+    """
+    Tables step of Cleaner, the text of an open table is held until it's closed, when it's dropped, or until the end
+    where it's kept as clean does with a table never closed. The last char of a text is held as it may start a tag
+    """
+    tags = lookahead([s.Table.start, s.Table.end])
+
+    def __init__(self, out):
+        self._out = out
+        self._tail = ''
+        self._held = []
+        self._depth = 0
+        # End of the last tag from the start of tail, tags overlapping it are skipped as Brackets does
+        self._last = 0
+        self._offset = 0
+        self._opening = None
+
+    def write(self, text):
+        text = self._tail + text
+        start = 0
+        last = self._last
+        for match in self.tags.finditer(text):
+            position = match.start()
+            if position < last:
+                continue
+            last = position + 2
+            if match.lastindex == 1:
+                if not self._depth:
+                    self._out.write(text[start:position])
+                    start = position
+                    self._opening = self._offset + position
+                self._depth += 1
+            elif self._depth:
+                self._depth -= 1
+                if not self._depth:
+                    self._held = []
+                    self._out.write(' ')
+                    start = last
+
+        end = max(len(text) - 1, last, 0)
+        if self._depth:
+            self._held.append(text[start:end])
+        else:
+            self._out.write(text[start:end])
+        self._tail = text[end:]
+        self._last = last - end
+        self._offset += end
+
+    def close(self):
+        if self._depth:
+            print(MalformedTag(s.Table.start, s.Table.end, self._opening).message)
+            self._out.write(''.join(self._held))
+        self._out.write(self._tail)
+        self._out.close()
+
+
+class _Refs:
+    """
+    Refs step of Cleaner, text is held from a <ref until its end is known. Without a /> after it that's only at the
+    end, the text is held to the end as the ref may run to a /> anywhere after
+    """
+
+    def __init__(self, out):
+        self._out = out
+        self._text = ''
+        self._held = []
+        self._slash = False
+
+    def write(self, text):
+        if self._held:
+            # Waiting for a />, the one of the ref can't be in the text held but its last char
+            if '/>' not in self._held[-1][-1:] + text[:1] and '/>' not in text:
+                self._held.append(text)
+                return
+            text = ''.join(self._held) + text
+            self._held = []
+        self._resolve(self._text + text)
+
+    def _resolve(self, text):
+        position = 0
+        while True:
+            opening = text.find('<ref', position)
+            if opening < 0:
+                # The last chars may start a <ref
+                end = max(len(text) - 3, position)
+                self._out.write(text[position:end])
+                self._text = text[end:]
+                return
+
+            slash = text.find('/>', opening + 4)
+            if slash < 0:
+                self._out.write(text[position:opening])
+                self._held = [text[opening:]]
+                self._text = ''
+                return
+
+            end = slash + 2
+            while True:
+                if text.startswith('</ref>', end):
+                    end += 6
+                elif text.startswith('!</ref>', end):
+                    end += 7
+                elif end + 7 > len(text) and ('!</ref>'.startswith(text[end:]) or '</ref>'.startswith(text[end:])):
+                    # Either one may go on in the next text
+                    self._out.write(text[position:opening])
+                    self._text = text[opening:]
+                    return
+                else:
+                    break
+            self._out.write(text[position:opening])
+            position = end
+
+    def close(self):
+        self._out.write(refs(''.join(self._held) + self._text))
+        self._out.close()
+
+
+class _Output:
+    """ Last step of Cleaner, collects the text cleaned from a chunk and sends it as one """
+
+    def __init__(self, write):
+        self._write = write
+        self._chunks = []
+
+    def write(self, text):
+        if text:
+            self._chunks.append(text)
+
+    def close(self):
+        if self._chunks:
+            self._write(''.join(self._chunks))
+            self._chunks = []
+
+
+class Cleaner:
+    """
+    Writer that cleans the text written to it and passes it on to write in chunks, the output is the same as clean
+    of the whole text. Text is cleaned every chunksize chars, each step holds back only the text it can't decide yet.
+    The text left is cleaned on close
+    :param write: function called with each chunk of cleaned text
+    """
+
+    def __init__(self, write, keep_tables=False, chunksize=2 ** 16):
+        self.chunksize = chunksize
+        self._chunks = []
+        self._size = 0
+        self._output = _Output(write)
+        refs_step = _Refs(self._output)
+        self._steps = _Quotes(refs_step if keep_tables else _Tables(refs_step))
+
+    def write(self, text):
+        self._chunks.append(text)
+        self._size += len(text)
+        if self._size >= self.chunksize:
+            self._steps.write(''.join(self._chunks))
+            self._chunks = []
+            self._size = 0
+            self._output.close()
+        return len(text)
+
+    def close(self):
+        self._steps.write(''.join(self._chunks))
+        self._chunks = []
+        self._size = 0
+        self._steps.close()
@@ -1,6 +1,6 @@
 import logging
 import parser.parser as p
-from utils.combinators import pipe, expect, extract, seq, sor, rep, ParseError
+from utils.combinators import pipe, expect, extract, seq, sor, rep, memo, nested, first, dispatch, ParseError
 from lexer.symbols import Template, Text, Link, Heading, Heading6, Heading5, Heading4, Heading3, Comment, LineBreak, \
     Bold, ItalicAndBold, Italic, List
 
@@ -8,6 +8,10 @@ import lexer.lexer as l
 
 logger = logging.getLogger('parsing')
 
+# Precedence of the tags sharing the same characters, longest first
+HEADINGS = [Heading6, Heading5, Heading4, Heading3, Heading]
+FORMATTING = [ItalicAndBold, Bold, Italic]
+
 
 # TODO move symbols in a own file
 class Grammar:
@@ -26,6 +30,53 @@ class Grammar:
     def rule(self, rule):
         pass
 
+    @staticmethod
+    def compile():
+        """Builds the combinators of the production rules once, rules look them up in Grammar.rules instead of
+        rebuilding them on every call. Alternatives are dispatched on the FIRST set of each rule
+        """
+        rules = Grammar.rules
+
+        def heading(start, end):
+            return first(start)(seq(
+                expect(start),
+                rep(dispatch(Grammar.epsilon, Grammar.template, Grammar.link, Grammar.formatting, at_least_one=True),
+                    end),
+                expect(end),
+                # expect(LineBreak.start))
+                Grammar.linebreak))
+
+        def format(start, end):
+            return first(start)(seq(
+                expect(start),
+                rep(dispatch(Grammar.epsilon, Grammar.link), end),
+                expect(end)))
+
+        rules['expression'] = dispatch(
+            Grammar.template,
+            Grammar.link,
+            Grammar.headings,
+            Grammar.epsilon,
+            Grammar.linebreak,
+            Grammar.list,
+            # Grammar.formatting
+        )
+        rules['template'] = seq(expect(Template.start), Grammar.epsilon, expect(Template.end))
+        rules['link'] = seq(expect(Link.start),
+                            Grammar.epsilon,
+                            rep(dispatch(Grammar.epsilon, Grammar.template, Grammar.link, Grammar.formatting,
+                                         Grammar.linebreak, at_least_one=True), Link.end),
+                            expect(Link.end))
+        rules['headings'] = dispatch(*[heading(i.start, i.end) for i in HEADINGS])
+        rules['epsilon'] = expect(Text.start)
+        rules['linebreak'] = expect(LineBreak.start)
+        rules['formatting'] = dispatch(*[format(i.start, i.end) for i in FORMATTING])
+        rules['comment'] = seq(expect(Comment.start), Grammar.epsilon, expect(Comment.end))
+        rules['list_item'] = seq(expect(List.start),
+                                 rep(dispatch(Grammar.epsilon, Grammar.template, Grammar.link, Grammar.headings,
+                                              Grammar.list, at_least_one=True), LineBreak.end),
+                                 expect(LineBreak.end, False))
+
     def expression(self):
         """
         Wikimedia primary expression
@@ -38,16 +89,7 @@ class Grammar:
         :param parser:
         :return:
         """
-        # sor(*Grammar.rules.values())
-        return sor(
-            self.template,
-            self.link,
-            self.headings,
-            self.epsilon,
-            self.linebreak,
-            self.list,
-            # self.formatting
-        )
+        return Grammar.rules['expression']
 
     @staticmethod
     def __expression():
@@ -60,6 +102,8 @@ class Grammar:
         )
 
     @staticmethod
+    @first(Template.start)
+    @memo
     def template(parser):
         """Template grammar
         Wikimedia ABNF
@@ -80,15 +124,16 @@ class Grammar:
         :param parser:
         :return:
         """
-        result = pipe(parser,
-                      seq(expect(Template.start), Grammar.epsilon, expect(Template.end)),
-                      extract)
+        result = pipe(parser, Grammar.rules['template'], extract)
         if result:
             return p.Node(p.TemplateP(result.value))
         return None
         # return TemplateT.parse(parser)
 
     @staticmethod
+    @first(Link.start)
+    @nested
+    @memo
     def link(parser):
         """Link grammar
         Wikimedia EBNF
@@ -121,13 +166,7 @@ class Grammar:
         def extractor(arr):
             return (lambda _, c, children, __: (c, children))(*arr)
 
-        result = pipe(parser,
-                      seq(expect(Link.start),
-                          Grammar.epsilon,
-                          rep(sor(Grammar.epsilon, Grammar.template, Grammar.link, Grammar.formatting,
-                                  Grammar.linebreak, at_least_one=True), Link.end),
-                          expect(Link.end)),
-                      extractor)
+        result = pipe(parser, Grammar.rules['link'], extractor)
 
         if result:
             (content, nodes) = result
@@ -139,6 +178,9 @@ class Grammar:
         return None
 
     @staticmethod
+    @first(*[i.start for i in HEADINGS])
+    @nested
+    @memo
     def headings(parser):
         """ Heading
         Wikimedia EBNF
@@ -158,35 +200,19 @@ class Grammar:
         header2     = "==", text, "==", linebreak;
 
         """
-        precedence = [
-            Heading6,
-            Heading5,
-            Heading4,
-            Heading3,
-            Heading
-        ]
-
         def extractor(r):
-            _, arr, __, linebreak = r
-            return arr
-
-        def heading(start, end):
-            return seq(
-                expect(start),
-                rep(sor(Grammar.epsilon, Grammar.template, Grammar.link, Grammar.formatting, at_least_one=True), end),
-                expect(end),
-                # expect(LineBreak.start))
-                Grammar.linebreak)
+            opening, arr, __, linebreak = r
+            return opening, arr
 
         try:
-            result = pipe(parser, sor(*[heading(i.start, i.end) for i in precedence]), extractor)
+            result = pipe(parser, Grammar.rules['headings'], extractor)
         except ParseError as e:
             return Grammar.epsilon(parser)
             # return p.TextP()
 
-        if result:
-            nodes = result
-            node = p.HeadingNode('Heading')
+        if result and result[1]:
+            opening, nodes = result
+            node = p.HeadingNode('Heading', len(opening.text))
             node.children = nodes
             return node
 
@@ -197,6 +223,8 @@ class Grammar:
         return Grammar.epsilon(parser)
 
     @staticmethod
+    @first(Text.start)
+    @memo
     def epsilon(parser):
         """Basic epsilon that consume the token and proceed aka Text for now.
         Maybe i'll further extend this to handle cases like left-recursion
@@ -204,34 +232,31 @@ class Grammar:
         :param parser:
         :return:
         """
-        result = expect(Text.start)(parser)
+        result = Grammar.rules['epsilon'](parser)
         if result:
-            return p.Node(p.TextP(result.text))
+            return p.Node(p.TextP(result.text, result.start, result.end))
         return None
 
     @staticmethod
+    @first(LineBreak.start)
+    @memo
     def linebreak(parser):
-        result = expect(LineBreak.start)(parser)
+        result = Grammar.rules['linebreak'](parser)
         if result:
-            return p.Node(p.LineBreakP(result.text))
+            return p.Node(p.LineBreakP(result.text, result.start, result.end))
         return None
 
     @staticmethod
+    @first(*[i.start for i in FORMATTING])
+    @nested
+    @memo
     def formatting(parser):
-        match = [ItalicAndBold, Bold, Italic]
-
-        def format(start, end):
-            return seq(
-                expect(start),
-                rep(sor(Grammar.epsilon, Grammar.link), end),
-                expect(end))
-
         def extractor(r):
             _, arr, __ = r
             return arr[0]
 
         try:
-            result = pipe(parser, sor(*[format(i.start, i.end) for i in match]), extractor)
+            result = pipe(parser, Grammar.rules['formatting'], extractor)
             if result:
                 return p.Node(p.FormattingP(result.value))
 
@@ -249,26 +274,24 @@ class Grammar:
         pass
 
     @staticmethod
+    @first(Comment.start)
+    @memo
     def comment(parser):
-        result = pipe(parser,
-                      seq(expect(Comment.start), Grammar.epsilon, expect(Comment.end)),
-                      extract)
+        result = pipe(parser, Grammar.rules['comment'], extract)
         if result:
             return p.Node(p.CommentP(result.value))
         return None
 
     @staticmethod
+    @first(List.start)
+    @nested
+    @memo
     def list_item(parser):
         def extractor(r):
             _, arr, _ = r
             return arr
 
-        result = pipe(parser,
-                      seq(expect(List.start),
-                          rep(sor(Grammar.epsilon, Grammar.template, Grammar.link, Grammar.headings, Grammar.list, at_least_one=True),
-                              LineBreak.end),
-                          expect(LineBreak.end, False)
-                          ), extractor)
+        result = pipe(parser, Grammar.rules['list_item'], extractor)
         if result:
             # return result
             node = p.Node(None)
@@ -278,6 +301,8 @@ class Grammar:
         return None
 
     @staticmethod
+    @first(List.start)
+    @memo
     def list(parser):
         # result = pipe(parser, rep(Grammar.list_item))
         acc = []
@@ -298,3 +323,6 @@ class Grammar:
     # @staticmethod
     # def formatting(parser):
     #     result = pipe(parser, sor())
+
+
+Grammar.compile()
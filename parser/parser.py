@@ -1,5 +1,8 @@
 import logging
 import re
+from array import array
+from functools import partial
+from itertools import count
 import lexer.lexer as lexer
 from utils.combinators import ParseError
 from parser import grammar as g
@@ -27,6 +30,8 @@ class Node:
                                       |
                                     ....
     """
+    # Attributes of the node besides value and children, kept by the compact Tree
+    attributes = ()
 
     def __init__(self, value=None):
         self.value = value
@@ -40,14 +45,31 @@ class Node:
         NodeVisitor.pretty_print(self)
         return ''
 
-    def compile(self, writer, parser):
+    def compile(self, writer, parser, visit=None):
+        """Renders the tree rooted in this node with an explicit stack, each node expands in what comes next
+        :param visit: function called with each node rendered before it's expanded, in render order
+        """
+        stack = [self]
+        pop, extend = stack.pop, stack.extend
+        while stack:
+            item = pop()
+            if isinstance(item, Node):
+                if visit is not None:
+                    visit(item)
+                steps = item.expand(writer, parser)
+                if steps:
+                    extend(reversed(steps))
+            else:
+                item()
+
+    def expand(self, writer, parser):
+        """Renders this node alone and returns the steps that follow in order, nodes or deferred writes"""
         parser.notify(self)
         if self.value:
             # breakpoint()
             self.value.render(writer)
 
-        for children in self.children:
-            children.compile(writer, parser)
+        return self.children
 
     # def __eq__(self, node):
 
@@ -55,56 +77,141 @@ class Node:
 class NodeVisitor:
     @staticmethod
     def pretty_print(node, _prefix="", _last=True):
-        print(_prefix, "`- " if _last else "|- ", node.value, sep="")
-        _prefix += "   " if _last else "|  "
-        child_count = len(node.children)
-        for i, child in enumerate(node.children):
-            _last = i == (child_count - 1)
-            NodeVisitor.pretty_print(child, _prefix, _last)
+        stack = [(node, _prefix, _last)]
+        while stack:
+            node, _prefix, _last = stack.pop()
+            print(_prefix, "`- " if _last else "|- ", node.value, sep="")
+            _prefix += "   " if _last else "|  "
+            child_count = len(node.children)
+            stack.extend((child, _prefix, i == (child_count - 1)) for i, child in reversed(list(enumerate(node.children))))
+
+    @staticmethod
+    def walk(node):
+        """Nodes of the tree in depth first pre-order"""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
 
     @staticmethod
     def compare(ast1, ast2):
         pass
 
 
+class TokenBuffer:
+    """Index addressable view of the lazy token stream, tokens are pulled from the lexer the first time an index is
+    read and kept afterwards, so the parser can move back and forth (packrat mode)
+    """
+
+    def __init__(self, tokens=()):
+        self._tokens = iter(tokens)
+        self._buffer = []
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def get(self, index):
+        """ Token at index or None past the end of the stream """
+        buffer = self._buffer
+        while len(buffer) <= index:
+            token = next(self._tokens, None)
+            if token is None:
+                return None
+            buffer.append(token)
+        return buffer[index] if index >= 0 else None
+
+
 class Parser:
-    def __init__(self):
+    """
+    :param packrat: memoize grammar rules by token index, tokens are buffered for the whole parse
+    :param compact: parse returns the root Cursor of a Tree instead of the Node tree
+    """
+
+    def __init__(self, packrat=False, compact=False):
         self._tokens = iter([])
+        self._buffer = None
+        self._memo = None
+        self._budget = None
+        self.packrat = packrat
+        self.compact = compact
         self._ast = Node()
         self._index = -1
         self._current = None
         # self.last = None
-        self._listeners = []
+        # Listeners by handle in registration order, the ones matching a value type are resolved once per type
+        self._listeners = {}
+        self._dispatch = {}
+        self._batches = {}
+        self._handles = count()
         self.lexer = lexer.Lexer()
         # self.expression =
         self._grammar = g.Grammar()
 
-    def parse(self, text, expression=None):
+    def parse(self, text, expression=None, budget=None):
         self._ast = Node()
+        for node in self.iter_parse(text, expression, budget):
+            self._ast.add(node)
+
+        if self.compact:
+            self._ast = Tree.build(self._ast, self.current.source).root
+        return self._ast
+
+    def iter_parse(self, text, expression=None, budget=None):
+        """
+        Top level nodes generator, each node is yielded as soon as it's reduced and the parser keeps no reference to
+        it, in packrat mode the memo table is cleared at every top level node as the parser never moves back
+        :param budget: utils.budget.Budget of the parse, BudgetExceeded is raised once a limit is passed
+        """
         try:
-            self._tokens = iter(self.lexer.tokenize(text))
+            if budget is not None:
+                budget.start()
+            self._budget = budget
+            # Nodes batched by an article that failed before its flush
+            self._batches = {}
+            self._tokens = self.lexer.iter_tokens(text)
+            self._index = -1
+            self._current = None
+            if self.packrat:
+                self._buffer = TokenBuffer(self._tokens)
+                self._memo = {}
             expression = expression if expression else self._grammar.expression()
             self.next()
             while self.current.token != lexer.Lexer.EOF:
                 result = expression(self)
                 # print(self.current, result)
                 if result:
-                    self._ast.add(result)
+                    if self._memo:
+                        self._memo.clear()
+                    yield result
                 else:
                     self.next()
 
         except (MalformedTag, ParseError) as e:
             raise e
-
-        return self._ast
+        finally:
+            self._buffer = None
+            self._memo = None
+            self._budget = None
 
     def next(self):
+        if self._buffer is not None:
+            token = self._buffer.get(self._index + 1)
+            if token is None:
+                return None
+            self._index = self._index + 1
+            self._current = token
+            if self._budget is not None:
+                self._budget.token(token)
+            return token
         try:
             # self.last_token = self._current
             token = next(self._tokens)
             # logging.info('Next token: ' + repr(token))
             self._index = self._index + 1
             self._current = token
+            if self._budget is not None:
+                self._budget.token(token)
             return token
         except StopIteration:
             return None
@@ -117,26 +224,79 @@ class Parser:
     def current(self):
         return self._current
 
-    def on(self, fn, type):
-        self._listeners.append((fn, type))
-        index = len(self._listeners) - 1
+    @property
+    def listening(self):
+        """ True if any listener is registered """
+        return bool(self._listeners)
+
+    @property
+    def budget(self):
+        """ Budget of the parse running, None if it has none """
+        return self._budget
+
+    @property
+    def memo(self):
+        """ Packrat memo table, None unless parsing in packrat mode """
+        return self._memo
+
+    def mark(self):
+        return self._index
+
+    def reset(self, index):
+        """ Move back or forth to the token at index, only in packrat mode """
+        if self._buffer is None:
+            raise ValueError('reset requires a packrat parser')
+        self._index = index
+        self._current = self._buffer.get(index)
+
+    def on(self, fn, type, batch=False):
+        """
+        Calls fn with every node whose value is an instance of type, a ParseTypes member or an Expression class
+        :param batch: call fn once per article with the list of matching nodes instead, see flush
+        :return: function removing the listener, calling it again does nothing
+        """
+        handle = next(self._handles)
+        self._listeners[handle] = (fn, getattr(type, 'value', type), batch)
+        self._dispatch.clear()
 
         def off():
-            if index >= 0:
-                self._listeners.pop(index)
+            if self._listeners.pop(handle, None):
+                self._batches.pop(handle, None)
+                self._dispatch.clear()
 
         return off
 
     def notify(self, node):
-        if node.value and len(self._listeners) > 0:
-            for fn, type in self._listeners:
-                if isinstance(node.value, type.value):
+        if node.value and self._listeners:
+            value_type = type(node.value)
+            listeners = self._dispatch.get(value_type)
+            if listeners is None:
+                listeners = self._dispatch[value_type] = tuple(
+                    (handle, fn, batch) for handle, (fn, expression, batch) in self._listeners.items()
+                    if issubclass(value_type, expression))
+            for handle, fn, batch in listeners:
+                if batch:
+                    self._batches.setdefault(handle, []).append(node)
+                else:
                     fn(node)
 
+    def flush(self):
+        """ Calls each batch listener with the nodes it matched since the last flush, the end of an article """
+        batches, self._batches = self._batches, {}
+        for handle, (fn, _, batch) in list(self._listeners.items()):
+            if batch:
+                fn(batches.get(handle, []))
+
 
 class Expression:
+    """Value of a node, start and end are the span of its text in the source when it comes from a token"""
+    start = None
+    end = None
+
     def __init__(self, exp):
         self.expression = exp
+        self.start = getattr(exp, 'start', None)
+        self.end = getattr(exp, 'end', None)
 
     def render(self, writer):
         raise NotImplementedError()
@@ -149,17 +309,21 @@ class Expression:
 
 
 class LineBreakP(Expression):
-    def __init__(self, text):
+    def __init__(self, text, start=None, end=None):
         super().__init__(text)
         self.text = text
+        self.start = start
+        self.end = end
 
     def render(self, writer):
         pass
 
 
 class TextP(Expression):
-    def __init__(self, text):
+    def __init__(self, text, start=None, end=None):
         self.text = text
+        self.start = start
+        self.end = end
 
     def render(self, writer):
         writer.write(self.text)
@@ -204,6 +368,8 @@ class LinkP(Expression):
 class TemplateP(Expression):
     def __init__(self, node):
         self.text = ''
+        self.start = node.start
+        self.end = node.end
 
     def render(self, writer):
         # Ignore templates
@@ -245,22 +411,28 @@ class LinkNode(Node):
     def is_media(self):
         return self.media.match(self.text)
 
-    def compile(self, writer, parser):
+    def expand(self, writer, parser):
         if not self.is_media():
             parser.notify(self)
             self.value.render(writer)
+        return ()
 
 
 class HeadingNode(Node):
-    def __init__(self, value):
+    """ Heading, level is the number of equals signs of its opening """
+    attributes = ('level',)
+
+    def __init__(self, value, level=None):
         super().__init__(value)
+        self.level = level
 
-    def compile(self, writer, parser):
+    def expand(self, writer, parser):
         parser.notify(self)
         writer.write('\n\n')
         for i in self.children:
             i.value.render(writer)
         writer.write('\n\n')
+        return ()
 
 
 # class ListItem
@@ -268,20 +440,189 @@ class ListNode(Node):
     def __init__(self, value):
         super().__init__(value)
 
-    def compile(self, writer, parser):
+    def expand(self, writer, parser):
+        steps = []
         for node in self.children:
-            # if isinstance(node.value, ListNode):
-            #     writer.write('\t'.expandtabs(1))
-            #     node.compile(writer, parser)
-            # else:
             if isinstance(node.children[0], ListNode):
-                writer.write('\t'.expandtabs(1))
-                node.compile(writer, parser)
+                steps += [partial(writer.write, '\t'.expandtabs(1)), node]
             else:
-                writer.write('•')
-                node.compile(writer, parser)
-                writer.write('\n')
+                steps += [partial(writer.write, '•'), node, partial(writer.write, '\n')]
                 # written = node.value.render(writer)
                 # if len(written.strip()) == 0:
                 #     writer.truncate(len(writer.getvalue()) - 1)
                 # else:
+        return steps
+
+
+class Tree:
+    """Compact AST, each node is a row of parallel arrays: kind, span of its text over the source, first child and
+    next sibling. Rows are stored in depth first pre-order, the root is row 0.
+
+    Values are rebuilt from the span on access, a kind is the node class along with the value class, or the value
+    itself when it is a constant like 'Heading'. Nodes with no value of their own span their descendants.
+    """
+    kinds = []
+    _kind_ids = {}
+    _cursors = {}
+
+    def __init__(self, source=''):
+        self.source = source
+        self._kinds = array('H')
+        self._starts = array('i')
+        self._ends = array('i')
+        self._first = array('i')
+        self._next = array('i')
+        # Values that can't be rebuilt from the source, by row
+        self._texts = {}
+        self._values = {}
+        self._attributes = {}
+
+    def __len__(self):
+        return len(self._kinds)
+
+    @classmethod
+    def build(cls, node, source):
+        tree = cls(source)
+        parents = []
+        last = {}
+        stack = [(node, -1)]
+        while stack:
+            node, parent = stack.pop()
+            row = tree._append(node)
+            parents.append(parent)
+            if parent >= 0:
+                if parent in last:
+                    tree._next[last[parent]] = row
+                else:
+                    tree._first[parent] = row
+                last[parent] = row
+            stack.extend((child, row) for child in reversed(node.children))
+
+        starts, ends = tree._starts, tree._ends
+        for row in range(len(tree) - 1, 0, -1):
+            parent = parents[row]
+            if starts[row] >= 0 and cls.kinds[tree._kinds[parent]][1] is None:
+                if starts[parent] < 0 or starts[row] < starts[parent]:
+                    starts[parent] = starts[row]
+                ends[parent] = max(ends[parent], ends[row])
+        return tree
+
+    @classmethod
+    def _kind(cls, node):
+        value = node.value
+        if isinstance(value, Expression) and value.start is not None:
+            key = (type(node), type(value), None)
+        elif value is None or isinstance(value, str):
+            key = (type(node), None, value)
+        else:
+            key = (type(node), None, None)
+        if key not in cls._kind_ids:
+            cls._kind_ids[key] = len(cls.kinds)
+            cls.kinds.append(key)
+        return cls._kind_ids[key]
+
+    def _append(self, node):
+        row = len(self._kinds)
+        kind = self._kind(node)
+        value = node.value
+        if self.kinds[kind][1] is not None:
+            self._starts.append(value.start)
+            self._ends.append(value.end)
+            if isinstance(value, TextP) and len(value.text) != value.end - value.start:
+                self._texts[row] = value.text
+        else:
+            self._starts.append(-1)
+            self._ends.append(-1)
+            if self.kinds[kind][2] is None and value is not None:
+                self._values[row] = value
+        if node.attributes:
+            self._attributes[row] = {name: getattr(node, name) for name in node.attributes}
+        self._kinds.append(kind)
+        self._first.append(-1)
+        self._next.append(-1)
+        return row
+
+    def kind(self, index):
+        """ (node class, value class, constant value) of the node at index """
+        return self.kinds[self._kinds[index]]
+
+    def span(self, index):
+        return self._starts[index], self._ends[index]
+
+    def text(self, index):
+        if index in self._texts:
+            return self._texts[index]
+        start, end = self._starts[index], self._ends[index]
+        return self.source[start:end] if start >= 0 else None
+
+    def value(self, index):
+        _, value_type, constant = self.kind(index)
+        if value_type is None:
+            return self._values.get(index, constant)
+        start, end = self.span(index)
+        text = TextP(self.text(index), start, end)
+        if issubclass(value_type, (TextP, LineBreakP)):
+            return value_type(text.text, start, end)
+        return value_type(text)
+
+    def first_child(self, index):
+        """ Row of the first child or -1 """
+        return self._first[index]
+
+    def next_sibling(self, index):
+        """ Row of the next sibling or -1 """
+        return self._next[index]
+
+    def children(self, index):
+        child = self._first[index]
+        while child >= 0:
+            yield child
+            child = self._next[child]
+
+    def cursor(self, index):
+        node_type = self.kind(index)[0]
+        if node_type not in self._cursors:
+            self._cursors[node_type] = type(node_type.__name__ + 'Cursor', (Cursor, node_type), {})
+        cursor = self._cursors[node_type](self, index)
+        if index in self._attributes:
+            cursor.__dict__.update(self._attributes[index])
+        return cursor
+
+    @property
+    def root(self):
+        return self.cursor(0)
+
+
+class Cursor:
+    """View of a Tree row standing in for the Node it was built from, so compile and listeners work unchanged.
+    Cursors are made on the fly for the node class of the row, value and children are built on first access
+    """
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+        self._value = None
+        self._children = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = self.tree.value(self.index)
+        return self._value
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = [self.tree.cursor(i) for i in self.tree.children(self.index)]
+        return self._children
+
+    @property
+    def text(self):
+        return self.value.text
+
+    @property
+    def span(self):
+        return self.tree.span(self.index)
+
+    def add(self, node):
+        raise TypeError('Tree nodes are read only')
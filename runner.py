@@ -0,0 +1,144 @@
+import argparse
+import json
+import logging
+import os
+from collections import Counter
+from pathlib import Path
+from compiler import Compiler, ARTICLE_ERRORS
+from dump import MultistreamDump
+
+""" Resumable compile of a whole multistream dump, e.g. python runner.py dump.xml.bz2 index.txt.bz2 output """
+
+logger = logging.getLogger()
+
+
+class Runner:
+    """
+    Compiles a multistream dump into shards of JSON Lines in folder, one {"id", "title", "text"} record per page or
+    {"id", "title", "error"} with the type of the error for a page that fails with one of ARTICLE_ERRORS.
+
+    A shard holds the pages of streams_per_shard streams. It's written to a temporary file and renamed into place
+    once complete, then the checkpoint is saved the same way with the offset of the next stream, the last page id and
+    the pages and errors by type so far. A run started on a folder with a checkpoint resumes from it, a crash loses
+    at most the shard being written, which is written again in full
+    :param dump: MultistreamDump to compile
+    :param folder: folder of the shards and of the checkpoint
+    :param streams_per_shard: streams in each shard, a checkpoint is saved after each one
+    :param compiler_type: class of the compiler of the workers
+    :param workers: number of processes, os.cpu_count() by default
+    :param limits: deadline, max_tokens and max_depth of each article as in Compiler.compile, an article passing one
+    is counted as a BudgetExceeded error
+    """
+    CHECKPOINT = 'checkpoint.json'
+
+    def __init__(self, dump, folder, streams_per_shard=64, compiler_type=Compiler, workers=None, **limits):
+        self.dump = dump
+        self.folder = Path(folder)
+        self.streams_per_shard = streams_per_shard
+        self.compiler_type = compiler_type
+        self.workers = workers
+        self.limits = limits
+
+    def checkpoint(self):
+        """ Saved checkpoint of the folder, a new one if there's none. A checkpoint of another dump raises
+        ValueError """
+        path = self.folder / self.CHECKPOINT
+        if not path.exists():
+            return {'dump': os.path.abspath(self.dump.path), 'size': os.path.getsize(self.dump.path), 'shard': 0,
+                    'offset': 0, 'last_id': None, 'pages': 0, 'errors': {}, 'done': False}
+        with path.open(encoding='utf8') as f:
+            checkpoint = json.load(f)
+        if (checkpoint['dump'], checkpoint['size']) != (os.path.abspath(self.dump.path),
+                                                        os.path.getsize(self.dump.path)):
+            raise ValueError(f'{path} is the checkpoint of {checkpoint["dump"]}')
+        return checkpoint
+
+    def run(self):
+        """ Compiles the dump from the last checkpoint to the end, returning the final checkpoint """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        checkpoint = self.checkpoint()
+        if checkpoint['done']:
+            return checkpoint
+        if checkpoint['offset']:
+            logger.info(f'Resuming from shard {checkpoint["shard"]} at offset {checkpoint["offset"]}')
+        errors = Counter(checkpoint['errors'])
+        lines = []
+        streams = 0
+        for (_, end), results in self.dump.compile_streams(self.compiler_type, self.workers, checkpoint['offset'],
+                                                               **self.limits):
+            for id, title, result in results:
+                if isinstance(result, ARTICLE_ERRORS):
+                    errors[result.type] += 1
+                    record = {'id': id, 'title': title, 'error': result.type}
+                else:
+                    record = {'id': id, 'title': title, 'text': result}
+                lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+                checkpoint['last_id'] = id
+                checkpoint['pages'] += 1
+            checkpoint['offset'] = end
+            streams += 1
+            if streams == self.streams_per_shard:
+                self._commit(checkpoint, lines, errors)
+                lines = []
+                streams = 0
+        if streams:
+            self._commit(checkpoint, lines, errors)
+        checkpoint['done'] = True
+        self._save(self.folder / self.CHECKPOINT, json.dumps(checkpoint))
+        return checkpoint
+
+    def _commit(self, checkpoint, lines, errors):
+        """ Writes the shard of lines, then the checkpoint after it """
+        self._save(self.shard(checkpoint['shard']), ''.join(lines))
+        checkpoint['shard'] += 1
+        checkpoint['errors'] = dict(errors)
+        self._save(self.folder / self.CHECKPOINT, json.dumps(checkpoint))
+        logger.info(f'Shard {checkpoint["shard"] - 1} committed, {checkpoint["pages"]} pages '
+                    f'{sum(errors.values())} errors, last id {checkpoint["last_id"]}')
+
+    def shard(self, number):
+        return self.folder / f'shard-{number:05d}.jsonl'
+
+    def shards(self):
+        """ Paths of the committed shards in order """
+        return [self.shard(number) for number in range(self.checkpoint()['shard'])]
+
+    @staticmethod
+    def _save(path, content):
+        # Written in full and flushed to disk before the rename, a reader or a restart sees the old file or the new one.
+        # The folder is flushed after it, else the rename itself may be lost to a power failure
+        temporary = path.with_name(path.name + '.tmp')
+        with temporary.open('w', encoding='utf8') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        folder = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(folder)
+        finally:
+            os.close(folder)
+
+
+def main(argv=None):
+    arguments = argparse.ArgumentParser(description='Compiles a multistream dump into shards of JSON Lines, resuming '
+                                                    'from the last checkpoint of the output folder')
+    arguments.add_argument('dump', help='pages-articles-multistream.xml.bz2 file')
+    arguments.add_argument('index', help='index of the dump')
+    arguments.add_argument('output', help='folder of the shards and of the checkpoint')
+    arguments.add_argument('--streams-per-shard', type=int, default=64)
+    arguments.add_argument('--workers', type=int, default=None)
+    arguments.add_argument('--deadline', type=float, default=None, help='seconds each article may take')
+    arguments.add_argument('--max-tokens', type=int, default=None, help='tokens each article may have')
+    arguments.add_argument('--max-depth', type=int, default=None, help='nesting each article may have')
+    args = arguments.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    runner = Runner(MultistreamDump(args.dump, args.index), args.output, args.streams_per_shard, workers=args.workers,
+                    deadline=args.deadline, max_tokens=args.max_tokens, max_depth=args.max_depth)
+    checkpoint = runner.run()
+    logger.info(f'{checkpoint["pages"]} pages in {checkpoint["shard"]} shards, errors {checkpoint["errors"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+from config import TEST_DATA
+import cache
+import compiler as c
+import lexer.lexer as l
+
+
+class OtherCompiler(c.Compiler):
+    pass
+
+
+def read(name):
+    with open(TEST_DATA / name, encoding='utf8') as f:
+        return f.read()
+
+
+def test_cache():
+    text = read('wikitext_algeria')
+    compiler = c.Compiler(cache.Cache(c.Compiler))
+    expected = c.Compiler().compile(text)
+
+    assert compiler.compile(text) == expected and compiler.compile(text) == expected
+    assert compiler.compile('[[a|b]] c') == c.Compiler().compile('[[a|b]] c')
+    assert compiler.cache.stats() == {'hits': 1, 'misses': 2, 'evictions': 0, 'entries': 2,
+                                      'size': len(expected) + len(compiler.compile('[[a|b]] c'))}
+
+
+def test_cache_lru():
+    compiler = c.Compiler(cache.Cache(c.Compiler, maxsize=6))
+    for text in ('aaa', 'bbb', 'aaa', 'ccc'):
+        compiler.compile(text)
+    # bbb is the least recently used
+    assert compiler.cache.evictions == 1 and len(compiler.cache) == 2
+    compiler.compile('aaa')
+    compiler.compile('bbb')
+    assert (compiler.cache.hits, compiler.cache.misses) == (2, 4)
+
+
+def test_cache_disk(tmp_path):
+    path = tmp_path / 'cache.db'
+    store = cache.Cache(c.Compiler, path=path)
+    expected = c.Compiler(store).compile('[[a|b]] c')
+    store.close()
+
+    store = cache.Cache(c.Compiler, path=path)
+    assert c.Compiler(store).compile('[[a|b]] c') == expected and store.hits == 1
+    store.close()
+
+    # Results of a different compiler are dropped
+    store = cache.Cache(OtherCompiler, path=path)
+    assert store.get(store.key('[[a|b]] c')) is None
+    store.close()
+    store = cache.Cache(c.Compiler, path=path)
+    assert store.get(store.key('[[a|b]] c')) is None
+
+
+def test_cache_listeners():
+    compiler = c.Compiler(cache.Cache(c.Compiler))
+    links = []
+    off = compiler.on(links.append, c.ParseTypes.LINK)
+    compiler.compile('[[a|b]] c')
+    compiler.compile('[[a|b]] c')
+    assert len(links) == 2 and compiler.cache.misses == 0
+    off()
+    compiler.compile('[[a|b]] c')
+    assert compiler.cache.misses == 1
+
+
+def test_fingerprint(monkeypatch):
+    fingerprint = cache.fingerprint(c.Compiler)
+    assert cache.fingerprint(c.Compiler) == fingerprint and cache.fingerprint(OtherCompiler) != fingerprint
+
+    monkeypatch.setitem(l.GLOBAL_TABLE, l.Symbol.RESERVED, l.GLOBAL_TABLE[l.Symbol.RESERVED][::-1])
+    assert cache.fingerprint(c.Compiler) != fingerprint
@@ -0,0 +1,262 @@
+import asyncio
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+from config import ROOT, TEST_DATA
+import compiler as c
+import parser.parser as p
+import pytest
+
+CORPUS = [ROOT / 'examples' / 'data' / 'wikitext_anarchism.txt',
+          ROOT / 'examples' / 'data' / 'wikitext_link_extraction.txt',
+          TEST_DATA / 'wikitext_algeria']
+
+
+@pytest.mark.parametrize('batch', [1, 128])
+@pytest.mark.parametrize('path', CORPUS, ids=lambda path: path.name)
+def test_stream(path, batch):
+    with path.open(encoding="utf8") as f:
+        text = f.read()
+
+    compiler, streaming = c.Compiler(), c.Compiler()
+    events, streamed = [], []
+    for parse_type in c.ParseTypes:
+        compiler.on(lambda node: events.append((type(node.value), node.value.text)), parse_type)
+        streaming.on(lambda node: streamed.append((type(node.value), node.value.text)), parse_type)
+
+    assert streaming.stream(text, batch) == compiler.compile(text)
+    assert streamed == events
+
+
+@pytest.mark.parametrize('path', CORPUS, ids=lambda path: path.name)
+def test_extract(path):
+    with path.open(encoding="utf8") as f:
+        text = f.read()
+
+    compiler = c.Compiler()
+    events = {parse_type: [] for parse_type in c.ParseTypes}
+    for parse_type in c.ParseTypes:
+        compiler.on(lambda node, t=parse_type: events[t].append(node.value.text), parse_type)
+    compiler.compile(text)
+    compiled = {t: list(nodes) for t, nodes in events.items()}
+
+    extracted = compiler.extract(text)
+    assert {t: [node.value.text for node in nodes] for t, nodes in extracted.items()} == compiled
+    assert {t: nodes[len(compiled[t]):] for t, nodes in events.items()} == compiled
+
+    links = c.Compiler().extract(text, [c.ParseTypes.LINK])
+    assert list(links) == [c.ParseTypes.LINK] and len(links[c.ParseTypes.LINK]) == len(compiled[c.ParseTypes.LINK])
+
+
+def test_compile_many():
+    texts = []
+    for path in CORPUS:
+        with path.open(encoding="utf8") as f:
+            texts.append(f.read())
+    texts += ['#REDIRECT [[Ancient Greece]]', '[[a {{b', '[[a|b', 'plain text'] * 3
+
+    compiler = c.Compiler()
+    expected = []
+    for text in texts:
+        try:
+            expected.append(compiler.compile(text))
+        except c.ARTICLE_ERRORS as e:
+            expected.append(e)
+
+    results = list(compiler.compile_many(iter(texts), workers=2, chunksize=2))
+    assert len(results) == len(expected)
+    for result, article in zip(results, expected):
+        if isinstance(article, Exception):
+            assert type(result) is type(article) and result.message == article.message
+        else:
+            assert result == article
+
+
+class CountingCompiler(c.Compiler):
+    compiled = 0
+
+    def compile(self, text):
+        CountingCompiler.compiled += 1
+        return super().compile(text)
+
+
+async def pages(texts, source):
+    """ Fake page source, records how many pages were read """
+    for text in texts:
+        await asyncio.sleep(0)
+        source.append(text)
+        yield text
+
+
+def test_compile_stream():
+    texts = ['[[a|b]] c', '[[a {{b', '{{b}} d', '#REDIRECT [[Ancient Greece]]'] * 4
+    compiler = c.Compiler()
+
+    async def run():
+        results, source = [], []
+        with ThreadPoolExecutor(2) as executor:
+            async for result in compiler.compile_stream(pages(texts, source), concurrency=3, executor=executor):
+                # Backpressure, no more than concurrency pages ahead of the consumer
+                assert len(source) - len(results) <= 3
+                results.append(result)
+        return results
+
+    results = asyncio.run(run())
+    assert len(results) == len(texts)
+    for text, result in zip(texts, results):
+        if isinstance(result, Exception):
+            with pytest.raises(type(result)):
+                compiler.compile(text)
+        else:
+            assert result == compiler.compile(text)
+
+
+def test_compile_async():
+    async def run():
+        with ThreadPoolExecutor(2) as executor:
+            text = await c.Compiler().compile_async('[[a|b]] c', executor)
+            with pytest.raises(c.ParseError):
+                await c.Compiler().compile_async('[[a|b', executor)
+        return text
+
+    assert asyncio.run(run()) == c.Compiler().compile('[[a|b]] c')
+
+
+def test_compile_stream_cancel():
+    texts = ['[[a|b]] c ' * 200] * 20
+    CountingCompiler.compiled = 0
+
+    async def run():
+        with ThreadPoolExecutor(1) as executor:
+            stream = CountingCompiler().compile_stream(pages(texts, []), concurrency=8, executor=executor)
+            async for _ in stream:
+                break
+            await stream.aclose()
+            # Cancellation reaches the executor on the next loop iteration
+            await asyncio.sleep(0)
+
+    asyncio.run(run())
+    # Articles queued behind the single worker never run
+    assert 1 <= CountingCompiler.compiled < 8
+
+
+@pytest.mark.parametrize('chunksize', [1, 4096, 2 ** 16])
+@pytest.mark.parametrize('path', CORPUS, ids=lambda path: path.name)
+def test_compile_to(path, chunksize):
+    with path.open(encoding="utf8") as f:
+        text = f.read()
+
+    compiler = c.Compiler()
+    chunks = []
+    assert compiler.compile_to(text, chunks.append, chunksize=chunksize) == len(compiler.compile(text))
+    assert ''.join(chunks) == compiler.compile(text)
+    assert chunksize > 1 or len(chunks) > 1
+
+    sink = io.StringIO()
+    compiler.compile_to(text, sink, chunksize=chunksize)
+    assert sink.getvalue() == compiler.compile(text)
+
+
+def test_structure():
+    text = "Intro {{Infobox person\n|name=x}} [[a|b]] [[File:c.png|thumb|[[d]]]]\n" \
+           "=== ''Early'' [[life]] ===\n[[e]] {{cite|f}} [[Category:G|sort]]\n"
+    compiler = c.Compiler()
+    assert compiler.structure(text) == {
+        'text': compiler.compile(text), 'sections': [{'title': 'Early life', 'level': 3}], 'links': ['a', 'e'],
+        'categories': ['G'], 'media': ['File:c.png'], 'templates': ['Infobox person', 'cite']}
+
+    sink = io.StringIO()
+    record = compiler.write_jsonl(text, sink, title='Page')
+    assert sink.getvalue().endswith('\n') and sink.getvalue().count('\n') == 1
+    assert json.loads(sink.getvalue()) == record and record['title'] == 'Page'
+
+    headings = '==[[Foo]]==\n==={{t}} x===\n====== y ======\n'
+    assert compiler.structure(headings)['sections'] == [
+        {'title': 'Foo', 'level': 2}, {'title': 'x', 'level': 3}, {'title': 'y', 'level': 6}]
+    tree = p.Parser(compact=True).parse(headings)
+    assert [node.level for node in tree.children if isinstance(node, p.HeadingNode)] == [2, 3, 6]
+
+
+@pytest.mark.parametrize('path', CORPUS, ids=lambda path: path.name)
+def test_structure_corpus(path):
+    with path.open(encoding="utf8") as f:
+        text = f.read()
+
+    compiler = c.Compiler()
+    links = [node.value.text for node in compiler.extract(text, [c.ParseTypes.LINK])[c.ParseTypes.LINK]]
+    record = compiler.structure(text)
+    assert record['text'] == compiler.compile(text)
+    assert len(record['links']) + len(record['categories']) == len(links)
+
+
+@pytest.mark.parametrize('path', CORPUS, ids=lambda path: path.name)
+def test_sections(path):
+    with path.open(encoding="utf8") as f:
+        text = f.read()
+
+    def render(source):
+        compiler = c.Compiler()
+        return compiler.render(compiler.parser.parse(source))
+
+    sections = c.Compiler().sections(text)
+    assert len(sections) > 1 and sections.lead.title == '' and sections.lead.level == 0
+    assert ''.join(section.source for section in sections) == text
+    assert ''.join(render(section.source) for section in sections) == render(text)
+    assert sections[sections.titles()[1]] is sections[1]
+
+
+def test_sections_lazy():
+    text = "Lead [[a]]\n== One ==\n{{t|\n== Not a heading ==\n}}\n=== Two [[b]] ===\n&lt;!--\n== Comment ==\n--&gt;x\n"
+    CountingCompiler.compiled = 0
+    sections = CountingCompiler().sections(text)
+    assert [(section.title, section.level) for section in sections] == [('', 0), ('One', 2), ('Two [[b]]', 3)]
+    assert CountingCompiler.compiled == 0
+
+    assert sections.lead.text == c.Compiler().compile('Lead [[a]]\n') and sections.lead.text is sections[0].text
+    assert CountingCompiler.compiled == 1
+    assert sections['One'].text == c.Compiler().compile(sections[1].source) and CountingCompiler.compiled == 2
+    with pytest.raises(KeyError):
+        sections['Not a heading']
+
+
+def test_budget():
+    with CORPUS[0].open(encoding="utf8") as f:
+        text = f.read()
+
+    compiler = c.Compiler()
+    assert compiler.compile(text, deadline=60, max_tokens=10 ** 6, max_depth=100) == c.Compiler().compile(text)
+
+    with pytest.raises(c.BudgetExceeded) as e:
+        compiler.compile(text, max_tokens=100)
+    assert e.value.limit == 'max_tokens' and e.value.stats['tokens'] == 101 and e.value.stats['position'] > 0
+
+    with pytest.raises(c.BudgetExceeded) as e:
+        compiler.compile(text, deadline=0)
+    assert e.value.limit == 'deadline' and e.value.stats['elapsed'] > 0
+
+    # Deeper than the recursion limit allows
+    with pytest.raises(c.BudgetExceeded) as e:
+        compiler.compile('[[a|' * 1000 + ']]' * 1000, max_depth=50)
+    assert e.value.limit == 'max_depth' and e.value.stats['depth'] == 51
+
+    # The parser is left ready for the next article
+    assert compiler.compile('[[a|b]] c') == 'b c' and compiler.parser.budget is None
+
+
+def test_budget_pool():
+    with CORPUS[0].open(encoding="utf8") as f:
+        text = f.read()
+
+    compiler = c.Compiler()
+    results = list(compiler.compile_many([text, 'a [[b]]'], workers=1, max_tokens=100))
+    assert isinstance(results[0], c.BudgetExceeded) and results[0].limit == 'max_tokens' and results[1] == 'a b'
+
+    async def run():
+        with ThreadPoolExecutor(2) as executor:
+            with pytest.raises(c.BudgetExceeded):
+                await compiler.compile_async(text, executor, max_tokens=100)
+            return [result async for result in compiler.compile_stream(pages([text, 'a b'], []), 2, executor,
+                                                                      max_depth=0)]
+
+    results = asyncio.run(run())
+    assert isinstance(results[0], c.BudgetExceeded) and results[0].limit == 'max_depth' and results[1] == 'a b'
@@ -1,69 +1,89 @@
+import bz2
 import pytest
-from lxml import etree
-from config import DUMP_FOLDER
-from compiler import Compiler
-from utils.combinators import ParseError
-from lexer.lexer import RedirectFound
-from lexer.utils import MalformedTag
+from collections import deque
+from config import DUMP_FOLDER, TEST_DATA
+from compiler import Compiler, ARTICLE_ERRORS
+from dump import DumpIndex, MultistreamDump, WikiXML, write_multistream
 import logging
 
 logger = logging.getLogger()
 
 
 @pytest.mark.slow
+@pytest.mark.skipif(not DUMP_FOLDER.is_dir(), reason='no dumps folder')
 def test_dump():
     directory = DUMP_FOLDER
     xml_parser = WikiXML(namespace='http://www.mediawiki.org/xml/export-0.10/')
     compiler = Compiler()
     miss = 0
+    titles = deque()
+
+    def texts(path):
+        for root in xml_parser.from_xml(path):
+            id, title, text = xml_parser.get(root)
+            titles.append(title.text)
+            yield text.text
+
     for wiki in directory.iterdir():
         if wiki.is_file() and wiki.stem.startswith('enwiki'):
-            for root in xml_parser.from_xml(str(wiki)):
-                listener = None
-                try:
-                    id, title, text = xml_parser.get(root)
-                    logger.info(f'{title.text} compiling')
-                    # if title.text.lower() == "athens":
-                    #     logger.info(text.text)
-                    article = compiler.compile(text.text)
-                    logger.info(f'{title.text} compiled')
-                except (ParseError, MalformedTag, RedirectFound) as e:
+            for article in compiler.compile_many(texts(str(wiki))):
+                title = titles.popleft()
+                if isinstance(article, ARTICLE_ERRORS):
                     miss += 1
-                    logger.info(f'{e.type}')
+                    logger.info(f'{title} {article.type}')
+                else:
+                    logger.info(f'{title} compiled')
 
     if miss > 0:
         logger.warning(f'{miss} articles ignored')
 
 
-class WikiXML:
+def test_from_xml():
+    xml_parser = WikiXML()
+    pages = [xml_parser.record(root) for root in xml_parser.from_xml(str(TEST_DATA / 'enwiki_test.xml'))]
+    assert len(pages) == 3 and pages[0][:2] == (73066, 'Dream Theater')
+    assert pages[0][2].startswith('{{About|the band|') and all(text for _, _, text in pages)
 
-    def __init__(self, namespace):
-        self._prefix = 'W'
-        self.TITLE = '{0}:title'.format(self._prefix)
-        self.TEXT = '{0}:revision/{0}:text'.format(self._prefix)
-        self.ID = '{0}:id'.format(self._prefix)
 
-        self.namespaces = {self._prefix: namespace}
-        self._base_tag = f'{{{namespace}}}' + 'page'
+def test_multistream(tmp_path):
+    xml_parser = WikiXML()
+    articles = [xml_parser.record(root) for root in xml_parser.from_xml(str(TEST_DATA / 'enwiki_test.xml'))]
+    articles.append((1, 'Redirect: a', '#REDIRECT [[a]]'))
+    pages = [(id + copy * 10 ** 8, title, text) for copy in range(3) for id, title, text in articles]
+    write_multistream(pages, tmp_path / 'dump.xml.bz2', tmp_path / 'index.txt.bz2', per_stream=5)
 
-    def from_xml(self, path):
-        context = etree.iterparse(path, events=('end',), tag=self._base_tag, huge_tree=True)
-        # TODO improve with iterchildren/iterdescendants instead of xpath
-        for _, root in context:
-            yield root
-            while root.getprevious() is not None:
-                del root.getparent()[0]
-            root.clear()
+    dump = MultistreamDump(tmp_path / 'dump.xml.bz2', tmp_path / 'index.txt.bz2')
+    assert len(dump.streams) == 3 and list(dump.entries())[3][1:] == (1, 'Redirect: a')
+    assert list(dump.pages()) == pages
+
+    compiler = Compiler()
+    results = list(dump.compile(workers=2))
+    assert [(id, title) for id, title, _ in results] == [(id, title) for id, title, _ in pages]
+    for (_, _, text), (_, _, result) in zip(pages, results):
+        if isinstance(result, ARTICLE_ERRORS):
+            with pytest.raises(type(result)):
+                compiler.compile(text)
+        else:
+            assert result == compiler.compile(text)
 
-    def title(self, root):
-        return root.xpath(self.TITLE, namespaces=self.namespaces)[0]
 
-    def text(self, root):
-        return root.xpath(self.TEXT, namespaces=self.namespaces)[0]
+def test_index(tmp_path):
+    xml_parser = WikiXML()
+    articles = [xml_parser.record(root) for root in xml_parser.from_xml(str(TEST_DATA / 'enwiki_test.xml'))]
+    pages = [(id + copy * 10 ** 8, f'{title} "AT&T" <{copy}>', text)
+             for copy in range(4) for id, title, text in articles]
+    write_multistream(pages, tmp_path / 'dump.xml.bz2', tmp_path / 'index.txt.bz2', per_stream=5)
 
-    def id(self, root):
-        return root.xpath(self.ID, namespaces=self.namespaces)[0]
+    multistream = DumpIndex.build(tmp_path / 'multistream.db', tmp_path / 'dump.xml.bz2', tmp_path / 'index.txt.bz2')
+    uncompressed = DumpIndex.build(tmp_path / 'xml.db', TEST_DATA / 'enwiki_test.xml')
+    assert len(multistream) == len(pages) and len(uncompressed) == len(articles)
+    for page in pages:
+        assert multistream.get(page[0]) == page and multistream.get(page[1]) == page
+    for page in articles:
+        assert uncompressed.get(page[0]) == page and uncompressed.get(page[1]) == page
+    assert multistream.get('Missing') is None and uncompressed.get(1) is None
+    with bz2.open(tmp_path / 'index.txt.bz2', 'rt', encoding='utf8') as f:
+        assert f.readline().endswith(':Dream Theater &quot;AT&amp;T&quot; &lt;0&gt;\n')
 
-    def get(self, root):
-        # TODO use a high order func
-        return self.id(root), self.title(root), self.text(root)
+    uncompressed.close()
+    assert DumpIndex(tmp_path / 'xml.db').find(articles[-1][1])[:2] == articles[-1][:2]
@@ -3,6 +3,8 @@ from ..config import TEST_DATA
 import lexer.lexer as l
 import lexer.utils as utils
 import pytest
+import re
+import time
 
 
 def test_tokenize():
@@ -38,6 +40,28 @@ def test_redirect():
         tokens = lexer.tokenize(text)
 
 
+def test_iter_tokens():
+    with open(TEST_DATA / 'wikitext_tokenize') as f:
+        text = f.read()
+        lexer = l.Lexer()
+        tokens = lexer.iter_tokens(text)
+        first = next(tokens)
+        assert lexer._col < len(text)
+        rest = list(tokens)
+        assert stream([first] + rest) == stream(l.Lexer().tokenize(text)) and rest[-1].token == l.Lexer.EOF
+
+
+def test_token_spans():
+    text = """[[a|[[b|{{c|{{d}}}}]]]]"""
+    tokens = l.Lexer().tokenize(text)
+    assert stream(tokens) == [('LINK_START', '[['), ('TEXT', 'a|'), ('LINK_START', '[['), ('TEXT', 'b|'),
+                              ('TEMPLATE_START', '{{'), ('TEXT', 'c|d'), ('TEMPLATE_END', '}}'),
+                              ('LINK_END', ']]'), ('LINK_END', ']]'), ('EOF', '')]
+    content = tokens[5]
+    assert (content.start, content.end) == (10, 17) and text[content.start:content.end] == 'c|{{d}}'
+    assert isinstance(tokens[-1], l.EOFToken) and tokens[-1].start == len(text)
+
+
 def test_newline():
     text = """Anarchism is political movement.\n"""
     lexer = l.Lexer()
@@ -61,3 +85,135 @@ def test_newline():
 #             m = match.pop(0)
 #
 #     assert len(match) == 0
+
+
+def stream(tokens):
+    return [(t.token.tag, t.text) for t in tokens]
+
+
+@pytest.mark.parametrize('filename', ['wikitext_tokenize', 'wikitext_algeria', 'wikitext_anarchism', 'abacus'])
+def test_scanner(filename):
+    with open(TEST_DATA / filename, encoding='utf8') as f:
+        text = f.read()
+        assert l.Lexer().scanner is not None
+        assert stream(l.Lexer().tokenize(text)) == stream(l.Lexer(scanner=False).tokenize(text))
+
+
+def test_scanner_pass_order():
+    text = '=============x\n{{x}}*b\n'
+    assert stream(l.Lexer().tokenize(text)) == stream(l.Lexer(scanner=False).tokenize(text))
+
+
+@pytest.mark.slow
+def test_tokenize_linear():
+    unit = '==History==\n' + 'The [[Anarchism|anarchist]] movement {{cite|{{nested|x}}}} grew &lt;!-- note --&gt; in ' \
+                             '<math>x^2</math> Europe.\n* item [[Link]]\n** sub item\n' * 4
+    per_char = []
+    for size in (10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7):
+        text = unit * (size // len(unit))
+        best = None
+        for _ in range(3 if size < 10 ** 6 else 1):
+            lexer = l.Lexer()
+            start = time.perf_counter()
+            for _ in lexer.iter_tokens(text):
+                pass
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        per_char.append(best / len(text))
+
+    # A quadratic lexer would grow the cost per char a thousand times from 10k to 10M chars
+    assert max(per_char) < 3 * min(per_char)
+
+
+def test_brackets():
+    text = """{{a|{{b}}}} [[c]] }} {{d"""
+    brackets = utils.Brackets(text, l.BRACKETS)
+    match = brackets.match(l.Template.start, l.Template.end, 0)
+    assert (match.start(), match.end()) == (0, 11) and brackets.openings(l.Template) == [0, 4, 21]
+    assert brackets.match(l.Link.start, l.Link.end, 12).end() == 17
+    assert brackets.unbalanced(l.Template) == [18, 21]
+
+    with pytest.raises(utils.MalformedTag) as e:
+        brackets.match(l.Template.start, l.Template.end, 21)
+    assert e.value.position == 21
+
+
+def test_clean_tables():
+    text = """a {| b {| c |} |} d {| e |} f"""
+    assert utils.clean(text) == 'a   d   f'
+
+
+def test_clean():
+    def reference(text):
+        for tag in (l.Bold, l.ItalicAndBold, l.Italic):
+            text = re.sub(tag.start.regex, '', text)
+        return re.sub(r'<ref[\s\S]*?\/\>(!?<\/ref\>)*|<ref[\s\S]*?\>*?[<]?\/ref\>', '', text)
+
+    texts = ["a" + "'" * n + "b" for n in range(10)] + [
+        "{''|a|} b", "a <ref>b</ref> c <ref name=d/></ref>!</ref> e", "a <ref>b<ref/ref> c", "<ref x/ref> <ref y",
+        "<references/> a <ref>b</ref>", "'''a''' <ref>''b''</ref> {| c |}"]
+    for text in texts:
+        assert utils.clean(text, keep_tables=True) == reference(text)
+    assert utils.clean("{''|a|} b") == '  b'
+
+
+def test_cleaner(capsys):
+    texts = ["a''' b {''| c <ref>d/> |} e <ref f/></ref>!</ref> g", "a {| b {| c |} d <ref e/ref> f", "a <ref b</ref> c"]
+    for text in texts:
+        expected = utils.clean(text)
+        printed = capsys.readouterr().out
+        for split in range(len(text) + 1):
+            chunks = []
+            cleaner = utils.Cleaner(chunks.append, chunksize=1)
+            cleaner.write(text[:split])
+            cleaner.write(text[split:])
+            cleaner.close()
+            assert ''.join(chunks) == expected and capsys.readouterr().out == printed
+
+
+def test_brackets_vectorized(monkeypatch):
+    pytest.importorskip('numpy')
+    with open(TEST_DATA / 'wikitext_tokenize', encoding='utf8') as f:
+        text = f.read() + '}} {{ {|'
+
+    def pairs(vectorize):
+        monkeypatch.setattr(utils.Brackets, 'vectorize', vectorize)
+        brackets = utils.Brackets(text, l.BRACKETS)
+        result = []
+        for tag in l.BRACKETS:
+            result.append(brackets.unbalanced(tag))
+            for opening in brackets.openings(tag):
+                if opening not in brackets.unbalanced(tag):
+                    match = brackets.match(tag.start, tag.end, opening)
+                    result.append([(t, start, end) for t, start, end in match.matches])
+        return result
+
+    assert pairs(0) == pairs(float('inf'))
+
+
+@pytest.mark.parametrize('vectorize', [0, float('inf')])
+def test_markup(monkeypatch, vectorize):
+    monkeypatch.setattr(utils.Markup, 'vectorize', vectorize)
+    text = """a [[b]]\n== c =="""
+    markup = utils.Markup(text, l.WIKIMEDIA_MARKUP)
+    assert [markup.next(i) for i in (0, 3, 4, 8, 11, 14)] == [2, 5, 5, 8, 13, 15]
+    assert markup.next(15) == len(text)
+    assert list(utils.Markup('a{{{', l.WIKIMEDIA_MARKUP).offsets) == [1, 2]
+
+
+def test_text_stops():
+    """ Text tokens stop where the Text lookahead regex does """
+    text = """a <code b }}} [[c]] <math>{{d}}</math> ==e==\n* f <gallery g"""
+    lexer = l.Lexer()
+    text_symbol = lexer.table[l.Symbol.ID][0]
+    for position in range(len(text)):
+        span, _ = text_symbol.match(text, position)
+        assert span.end() == l.Text.start.match(text, position).end()
+
+
+def test_ignored_regions():
+    text = """<math>a</math> <code b <math>c</math> <!--> d -->"""
+    regions = utils.Regions(text, l.IGNORED_TAGS)
+    assert regions.offsets == [0, 23, 38]
+    assert regions.match(0).end() == 14 and regions.match(23).end() == 37 and regions.match(38).end() == len(text)
+    assert regions.match(15) is None
@@ -1,6 +1,8 @@
 from config import TEST_DATA
 import parser.parser as p
 import compiler as c
+import parser.grammar as g
+from utils.combinators import sor, ParseError
 import lexer.lexer as l
 import pytest
 import traceback
@@ -37,6 +39,13 @@ def test_headings():
 #         print(w_compiler.compile(text))
 
 
+def test_parse_redirect():
+    text = """#REDIRECT [[Ancient Greece]]{{Rcat shell|{{R move}}{{R related}}{{R unprintworthy}}}}"""
+    parser = p.Parser()
+    with pytest.raises(l.RedirectFound):
+        parser.parse(text)
+
+
 def test_parse_list():
     text = """
 * asd
@@ -59,3 +68,170 @@ def test_parse_list():
 #     parser = p.Parser()
 #     ast = parser.parse(txt)
 #     assert isinstance(ast.children[0].value, p.FormattingP) and ast.children[0].value.expression.text == 'History'
+
+
+NESTED = ''.join('[[x|' * d + 'y' + ']]' * d + '\n' for d in range(1, 30)) + \
+         '== [[a|[[b]]]] {{t}} ==\n' * 10 + '== [[a|[[b]]]] broken\n' * 10 + "'''[[a]]''' ''b''\n"
+
+
+def shape(node):
+    return type(node).__name__, type(node.value).__name__, getattr(node.value, 'text', None), \
+           [shape(child) for child in node.children]
+
+
+@pytest.mark.parametrize('name', ['wikitext_algeria', 'wikitext_anarchism', 'wikitext_link_extraction', None])
+def test_packrat(name):
+    if name:
+        with (TEST_DATA / name).open(encoding="utf8") as f:
+            text = f.read()
+    else:
+        text = NESTED
+
+    compiler, packrat = c.Compiler(), c.Compiler()
+    packrat.parser = p.Parser(packrat=True)
+    assert shape(packrat.parser.parse(text)) == shape(compiler.parser.parse(text))
+    assert packrat.compile(text) == compiler.compile(text)
+
+
+def test_packrat_replay():
+    calls = []
+
+    def twice(rule):
+        def parse(parser):
+            start = parser.mark()
+            outcomes = []
+            for _ in range(2):
+                parser.reset(start)
+                try:
+                    outcomes.append((rule(parser), parser.mark()))
+                except ParseError as e:
+                    outcomes.append((e, parser.mark()))
+            calls.append(outcomes)
+            return outcomes[0][0] if not isinstance(outcomes[0][0], ParseError) else None
+
+        return parse
+
+    parser = p.Parser(packrat=True)
+    parser.parse('[[a|[[b]]]] [[c {{t}}', sor(twice(g.Grammar.link), twice(g.Grammar.epsilon)))
+    first, second = calls[0]
+    assert first[0] is second[0] and first[1] == second[1]
+    error = next(outcomes for outcomes in calls if isinstance(outcomes[0][0], ParseError))
+    assert error[0] == error[1]
+
+
+@pytest.mark.parametrize('text', ['== [[a]] broken\n* x\n[[b]]', '=== a ==\n{{t}}\n== b ==\n', NESTED])
+def test_dispatch(text):
+    expression = sor(g.Grammar.template, g.Grammar.link, g.Grammar.headings, g.Grammar.epsilon, g.Grammar.linebreak,
+                     g.Grammar.list)
+    assert shape(p.Parser().parse(text)) == shape(p.Parser().parse(text, expression))
+
+
+def test_compile_deep(capsys):
+    depth = 10000
+    compiler = c.Compiler()
+    tree = p.Node(p.TextP('a'))
+    for _ in range(depth):
+        tree, child = p.Node(p.TextP('a')), tree
+        tree.add(child)
+    seen = []
+    compiler.on(seen.append, c.ParseTypes.LINK)
+    assert compiler.render(tree) == 'a' * (depth + 1)
+    assert len(list(p.NodeVisitor.walk(tree))) == depth + 1
+
+    item = p.Node()
+    item.add(p.Node(p.TextP('a')))
+    for _ in range(depth):
+        nested = p.ListNode('List')
+        nested.add(item)
+        item = p.Node()
+        item.add(nested)
+    assert compiler.render(item) == ' ' * (depth - 1) + '•a\n'
+
+    tree = p.Node()
+    for _ in range(1500):
+        tree, child = p.Node(), tree
+        tree.add(child)
+    p.NodeVisitor.pretty_print(tree)
+    assert capsys.readouterr().out.count('\n') == 1501
+
+
+@pytest.mark.parametrize('name', ['wikitext_anarchism', 'wikitext_link_extraction'])
+def test_compact(name):
+    with (TEST_DATA / name).open(encoding="utf8") as f:
+        text = f.read()
+
+    ast = p.Parser().parse(text)
+    tree = p.Parser(compact=True).parse(text).tree
+    nodes = list(p.NodeVisitor.walk(ast))
+    assert len(tree) == len(nodes)
+    for row, node in enumerate(nodes):
+        cursor = tree.cursor(row)
+        assert isinstance(cursor, type(node)) and type(cursor.value) is type(node.value)
+        assert getattr(cursor.value, 'text', None) == getattr(node.value, 'text', None)
+        assert len(cursor.children) == len(node.children)
+
+    compiler, compact = c.Compiler(), c.Compiler()
+    compact.parser = p.Parser(compact=True)
+    links, compact_links = [], []
+    compiler.on(lambda node: links.append(node.value.text), c.ParseTypes.LINK)
+    compact.on(lambda node: compact_links.append(node.value.text), c.ParseTypes.LINK)
+    assert compact.compile(text) == compiler.compile(text)
+    assert compact_links == links
+
+
+def test_compact_spans():
+    text = '== [[a|b]] c ==\n{{t}}'
+    tree = p.Parser(compact=True).parse(text).tree
+    heading = next(row for row in range(len(tree)) if tree.kind(row)[0] is p.HeadingNode)
+    space = tree.first_child(heading)
+    link = tree.next_sibling(space)
+    assert tree.span(heading) == (2, 13) and tree.text(space) == ' ' and tree.text(link) == 'a|b'
+    assert tree.text(tree.next_sibling(link)) == ' c ' and tree.next_sibling(tree.next_sibling(link)) == -1
+    template = [row for row in range(len(tree)) if tree.kind(row)[1] is p.TemplateP]
+    assert len(template) == 1 and tree.text(template[0]) == 't' and tree.cursor(template[0]).value.text == ''
+
+
+def test_listeners():
+    class Category(p.LinkP):
+        pass
+
+    parser = p.Parser()
+    calls = []
+    offs = [parser.on(lambda node, i=i: calls.append(i), c.ParseTypes.LINK) for i in range(4)]
+    parser.on(lambda node: calls.append('category'), Category)
+    offs[1]()
+    offs[0]()
+    offs[0]()
+    link = p.Node(p.TextP('a'))
+    link.value = Category(link.value)
+    parser.notify(link)
+    parser.notify(p.Node(p.TextP('b')))
+    assert calls == [2, 3, 'category']
+
+
+def test_batch_listeners():
+    with (TEST_DATA / 'wikitext_anarchism').open(encoding="utf8") as f:
+        text = f.read()
+
+    compiler = c.Compiler()
+    links, batches = [], []
+    compiler.on(links.append, c.ParseTypes.LINK)
+    off = compiler.on(batches.append, c.ParseTypes.LINK, batch=True)
+    compiler.compile(text)
+    compiler.stream(text)
+    assert len(batches) == 2 and batches[0] == links[:len(links) // 2] and len(batches[1]) == len(links) // 2
+    off()
+    compiler.compile(text)
+    assert len(batches) == 2
+
+
+def test_batch_listeners_failed_article():
+    compiler = c.Compiler()
+    batches = []
+    compiler.on(batches.append, c.ParseTypes.LINK, batch=True)
+    for method in (compiler.stream, compiler.compile, compiler.structure):
+        with pytest.raises(c.ARTICLE_ERRORS):
+            method('[[a]] x\n' * 200 + '[[b|c')
+        method('[[d]]')
+        assert [[node.value.text for node in batch] for batch in batches] == [['d']]
+        batches.clear()
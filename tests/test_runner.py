@@ -0,0 +1,99 @@
+import json
+import os
+import pytest
+import stat
+from config import TEST_DATA
+from dump import MultistreamDump, WikiXML, write_multistream
+from runner import Runner, main
+
+
+@pytest.fixture
+def dump(tmp_path):
+    xml_parser = WikiXML()
+    articles = [xml_parser.record(root) for root in xml_parser.from_xml(str(TEST_DATA / 'enwiki_test.xml'))]
+    articles.append((1, 'Redirect', '#REDIRECT [[a]]'))
+    pages = [(id + copy * 10 ** 8, title, text) for copy in range(5) for id, title, text in articles]
+    write_multistream(pages, tmp_path / 'dump.xml.bz2', tmp_path / 'index.txt.bz2', per_stream=3)
+    return MultistreamDump(tmp_path / 'dump.xml.bz2', tmp_path / 'index.txt.bz2')
+
+
+def records(runner):
+    lines = []
+    for shard in runner.shards():
+        with shard.open(encoding='utf8') as f:
+            lines.extend(json.loads(line) for line in f)
+    return lines
+
+
+class Crash(Exception):
+    pass
+
+
+class CrashingRunner(Runner):
+    """ Stops the run as a crash would after committing the first commits shards """
+    commits = 2
+
+    def _commit(self, checkpoint, lines, errors):
+        if self.commits == 0:
+            raise Crash()
+        self.commits -= 1
+        super()._commit(checkpoint, lines, errors)
+
+
+def test_runner(dump, tmp_path):
+    runner = Runner(dump, tmp_path / 'output', streams_per_shard=2, workers=1)
+    checkpoint = runner.run()
+    pages = list(dump.pages())
+    assert checkpoint['done'] and checkpoint['shard'] == 4 and checkpoint['pages'] == len(pages)
+    assert checkpoint['errors'] == {'RedirectFound': 5} and checkpoint['last_id'] == pages[-1][0]
+    assert [(record['id'], record['title']) for record in records(runner)] == [(id, title) for id, title, _ in pages]
+    assert sorted(path.name for path in (tmp_path / 'output').iterdir()) == [
+        'checkpoint.json', 'shard-00000.jsonl', 'shard-00001.jsonl', 'shard-00002.jsonl', 'shard-00003.jsonl']
+    assert runner.run() == checkpoint
+
+
+def test_runner_resume(dump, tmp_path):
+    expected = Runner(dump, tmp_path / 'expected', streams_per_shard=2, workers=1)
+    expected.run()
+
+    crashing = CrashingRunner(dump, tmp_path / 'output', streams_per_shard=2, workers=1)
+    with pytest.raises(Crash):
+        crashing.run()
+    checkpoint = crashing.checkpoint()
+    assert not checkpoint['done'] and checkpoint['shard'] == 2 and checkpoint['offset'] == dump.streams[4][0]
+    assert checkpoint['pages'] == 12 and checkpoint['errors'] == {'RedirectFound': 3}
+
+    resumed = Runner(dump, tmp_path / 'output', streams_per_shard=2, workers=1)
+    assert resumed.run() == expected.checkpoint()
+    assert records(resumed) == records(expected)
+    for number in range(4):
+        assert resumed.shard(number).read_text(encoding='utf8') == expected.shard(number).read_text(encoding='utf8')
+
+    with pytest.raises(ValueError):
+        Runner(MultistreamDump(TEST_DATA / 'enwiki_test.xml', dump.index), tmp_path / 'output').run()
+
+
+def test_runner_budget(dump, tmp_path):
+    checkpoint = Runner(dump, tmp_path / 'output', workers=1, max_tokens=50).run()
+    assert checkpoint['errors'] == {'RedirectFound': 5, 'BudgetExceeded': 15}
+
+
+def test_main(dump, tmp_path):
+    main([dump.path, dump.index, str(tmp_path / 'output'), '--workers', '1'])
+    assert Runner(dump, tmp_path / 'output').checkpoint()['pages'] == 20
+    main([dump.path, dump.index, str(tmp_path / 'budget'), '--workers', '1', '--deadline', '0'])
+    assert Runner(dump, tmp_path / 'budget').checkpoint()['errors']['BudgetExceeded'] == 15
+
+
+def test_save(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+
+    def record(fd):
+        synced.append((stat.S_ISDIR(os.fstat(fd).st_mode), os.path.exists(tmp_path / 'a.json')))
+        fsync(fd)
+
+    monkeypatch.setattr(os, 'fsync', record)
+    Runner._save(tmp_path / 'a.json', '{}')
+    # The file before the rename, then the folder holding the rename
+    assert synced == [(False, False), (True, True)] and os.listdir(tmp_path) == ['a.json']
@@ -0,0 +1,64 @@
+import time
+
+""" Limits on the work of a parse, checked by the parser as it goes on so no signal or thread is needed """
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, limit, stats):
+        self.type = 'BudgetExceeded'
+        self.limit = limit
+        self.stats = stats
+        self.message = f"BudgetExceeded: {limit} {stats}"
+
+
+class Budget:
+    """
+    Limits of one article, the parser counts each token it reads and each nested rule it enters and raises
+    BudgetExceeded with the stats so far as soon as one limit is passed. The lexer runs as tokens are read, so its time
+    is accounted for as well
+    :param deadline: seconds the parse may take, the clock is read every interval tokens
+    :param max_tokens: tokens the parser may read
+    :param max_depth: nesting of the rules that contain other rules, e.g. links within links
+    """
+    interval = 256
+
+    def __init__(self, deadline=None, max_tokens=None, max_depth=None):
+        self.deadline = deadline
+        self.max_tokens = max_tokens
+        self.max_depth = max_depth
+        self.tokens = 0
+        self.depth = 0
+        self.deepest = 0
+        self._started = None
+        self._expires = None
+
+    def start(self):
+        self.tokens = self.depth = self.deepest = 0
+        self._started = time.perf_counter()
+        self._expires = None if self.deadline is None else self._started + self.deadline
+
+    def token(self, token):
+        self.tokens += 1
+        if self.max_tokens is not None and self.tokens > self.max_tokens:
+            raise self.exceeded('max_tokens', token)
+        if self._expires is not None and not self.tokens % self.interval and time.perf_counter() > self._expires:
+            raise self.exceeded('deadline', token)
+
+    def enter(self, token):
+        self.depth += 1
+        if self.depth > self.deepest:
+            self.deepest = self.depth
+            if self.max_depth is not None and self.depth > self.max_depth:
+                raise self.exceeded('max_depth', token)
+
+    def leave(self):
+        self.depth -= 1
+
+    def stats(self, token=None):
+        """ Tokens read, deepest nesting, seconds elapsed and offset of the token the parser was at """
+        return {'tokens': self.tokens, 'depth': self.deepest,
+                'elapsed': time.perf_counter() - self._started if self._started is not None else 0.0,
+                'position': getattr(token, 'start', None)}
+
+    def exceeded(self, limit, token):
+        return BudgetExceeded(limit, self.stats(token))
@@ -43,6 +43,51 @@ def sor(*args, at_least_one=False):
     return parse
 
 
+def first(*tokens):
+    """ FIRST set of a rule, the tokens it can start with. Without one a rule is tried on any token """
+
+    def decorator(rule):
+        rule.first = frozenset(token.tag for token in tokens)
+        return rule
+
+    return decorator
+
+
+def dispatch(*args, at_least_one=False):
+    """ sor that looks up the alternatives by the current token in a table built from their FIRST sets, so only the
+    ones that can match are tried, in the same order. An alternative that fails after consuming tokens moves the
+    parser, the following ones are then looked up again by the new token like sor would try them
+    """
+    indexed = list(enumerate(args))
+    default = [(i, rule) for i, rule in indexed if not hasattr(rule, 'first')]
+    tags = {tag for rule in args for tag in getattr(rule, 'first', ())}
+    table = {tag: [(i, rule) for i, rule in indexed if tag in getattr(rule, 'first', (tag,))] for tag in tags}
+
+    def parse(parser):
+        index = parser.index
+        candidates = table.get(parser.current.token.tag, default)
+        k = 0
+        while k < len(candidates):
+            position, rule = candidates[k]
+            result = rule(parser)
+            if result is not None:
+                return result
+            if parser.index != index:
+                index = parser.index
+                candidates = [c for c in table.get(parser.current.token.tag, default) if c[0] > position]
+                k = 0
+            else:
+                k = k + 1
+
+        if at_least_one:
+            raise ParseError('Syntax error, sor rule failed')
+        return None
+
+    if not default:
+        parse.first = frozenset(tags)
+    return parse
+
+
 def pipe(arg, *args):
     """ Pipe """
     last_result = arg
@@ -65,6 +110,54 @@ def expect(token, consume=True):
     return parse
 
 
+def memo(rule):
+    """ Packrat memoization of a rule, active only when the parser runs in packrat mode
+
+    The outcome of rule at a token index, either its result or the ParseError it raised, is stored together with the
+    index where the rule left the parser, a second call at the same index resets the parser there and replays it.
+    """
+
+    def parse(parser):
+        table = parser.memo
+        if table is None:
+            return rule(parser)
+
+        key = (rule, parser.index)
+        if key in table:
+            result, end, error = table[key]
+            parser.reset(end)
+            if error:
+                raise result
+            return result
+
+        try:
+            result = rule(parser)
+        except ParseError as e:
+            table[key] = (e, parser.mark(), True)
+            raise e
+        table[key] = (result, parser.mark(), False)
+        return result
+
+    return parse
+
+
+def nested(rule):
+    """ Counts the nesting of a rule that contains other rules on the parser budget, when the parser has one """
+
+    def parse(parser):
+        budget = parser.budget
+        if budget is None:
+            return rule(parser)
+
+        budget.enter(parser.current)
+        try:
+            return rule(parser)
+        finally:
+            budget.leave()
+
+    return parse
+
+
 def extract(result):
     if result:
         __left, content, __right = result